@@ -114,6 +114,46 @@ def spectral_analysis(data):
     plt.show()
 
 
+class IncrementalSTFT(object):
+    """
+    Computes the short-time Fourier transform of a stream as it
+    arrives, a segment at a time. Only the samples that have not yet
+    made up a whole window are kept in between updates, such that
+    every window is transformed exactly once, instead of recomputing
+    the whole STFT for every new segment like spectral_analysis.
+
+    Windows of <nperseg> samples overlap by <noverlap> samples, and
+    only the lowest <num_buckets> frequency bins are kept (all if
+    None). The result matches scipy.signal.stft with boundary=None and
+    padded=False.
+    """
+    def __init__(self, sample_rate, nperseg=500, noverlap=400, window='hamming', num_buckets=None):
+        self.sample_rate = sample_rate
+        self.nperseg = nperseg
+        self.hop = nperseg - noverlap
+        self.window = get_window(window, nperseg).astype(np.float32)
+        self.scale = 1 / self.window.sum()
+        self.frequencies = np.fft.rfftfreq(nperseg, 1 / sample_rate)[:num_buckets]
+        self.num_buckets = len(self.frequencies)
+        self.pending = np.empty(0, dtype=np.float32)
+
+
+    def update(self, samples):
+        """
+        Appends <samples> to the stream, and returns the magnitudes of
+        the windows they completed as a (num_buckets, windows) array.
+        """
+        data = np.concatenate([self.pending, samples])
+        windows = (len(data) - self.nperseg) // self.hop + 1 if len(data) >= self.nperseg else 0
+        self.pending = data[windows*self.hop:]
+        if windows == 0:
+            return np.empty((self.num_buckets, 0), dtype=np.float32)
+
+        frames = np.lib.stride_tricks.sliding_window_view(data, self.nperseg)[::self.hop][:windows]
+        spectrum = np.fft.rfft(frames * self.window, axis=1)[:, :self.num_buckets]
+        return (np.abs(spectrum) * self.scale).astype(np.float32).T
+
+
 experiment_fp = 'mea_data/1.h5'
 
 # Only used such that you don't have to keep passing the channel and
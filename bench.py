@@ -0,0 +1,488 @@
+"""
+Benchmarks for the hot paths of SiNRI. None of these require a remote
+MEAME server, as data is fed through local socket pairs. Select which
+benchmarks to run with command line arguments (launch with --help).
+"""
+import log
+logger = log.get_logger(__name__)
+
+import os
+import socket
+import struct
+import threading
+import time
+import numpy as np
+import pyqtgraph as pg
+import analysis
+import cleaviz
+import meamer
+import grinder
+import experiment
+import mock
+import demo_receiver
+import sthread
+import synthetic
+import lib.detect_peaks as dp
+from exceptions import UnresponsiveMEAMEError
+from scipy.signal import stft
+
+
+def feed_socket(s, payload, repeats):
+    """
+    Writes <payload> to the socket <s> <repeats> times, used to play
+    the role of a remote host in the benchmarks.
+    """
+    try:
+        for _ in range(repeats):
+            s.sendall(payload)
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+
+
+def local_meamer(segment_length):
+    """
+    Creates a MEAMEr that receives DAQ data from a local socket pair
+    instead of a remote MEAME. Returns the MEAMEr and the socket that
+    should be written to.
+    """
+    meame = meamer.MEAMEr('localhost')
+    meame.initialize_DAQ(sample_rate=10000, segment_length=segment_length)
+    meame.DAQ_listener, remote = socket.socketpair()
+    return meame, remote
+
+
+def report(name, samples, elapsed):
+    print('{:<40} {:>10.3f} s {:>14,.0f} samples/s'.format(name, elapsed, samples / elapsed))
+
+
+def bench_segment_decoding(segment_length=1000, segments=600):
+    """
+    Compares recv_segment (struct unpacking in Python) to
+    recv_segment_array (recv_into and a NumPy scale) in samples
+    decoded per second.
+    """
+    counts = np.random.randint(-2**16, 2**16, segment_length, dtype='<i4')
+    payload = counts.tobytes()
+
+    for name in ['recv_segment', 'recv_segment_array']:
+        meame, remote = local_meamer(segment_length)
+        feeder = threading.Thread(target=feed_socket, args=(remote, payload, segments))
+        feeder.start()
+
+        recv = getattr(meame, name)
+        start = time.perf_counter()
+        for _ in range(segments):
+            recv()
+        elapsed = time.perf_counter() - start
+
+        feeder.join()
+        meame.disable_DAQ_listener()
+        remote.close()
+        report('MEAMEr.{}'.format(name), segments*segment_length, elapsed)
+
+
+def bench_frame_decoding(segment_length=1000, frames=100):
+    """
+    Compares receiving a frame of all channels as 60 calls to
+    recv_segment_array against a single call to recv_frame.
+    """
+    counts = np.random.randint(-2**16, 2**16, 60*segment_length, dtype='<i4')
+    payload = counts.tobytes()
+
+    def recv_segments(meame):
+        for ch in range(60):
+            meame.recv_segment_array()
+
+    def recv_frame(meame):
+        meame.recv_frame()
+
+    for name, recv in [('60 x recv_segment_array', recv_segments),
+                       ('recv_frame', recv_frame)]:
+        meame, remote = local_meamer(segment_length)
+        feeder = threading.Thread(target=feed_socket, args=(remote, payload, frames))
+        feeder.start()
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            recv(meame)
+        elapsed = time.perf_counter() - start
+
+        feeder.join()
+        meame.disable_DAQ_listener()
+        remote.close()
+        report('MEAMEr {}'.format(name), frames*60*segment_length, elapsed)
+
+
+def drain_socket(s):
+    try:
+        while s.recv(1 << 20):
+            pass
+    except OSError:
+        pass
+
+
+def legacy_publish(stream, frame):
+    """
+    The publish path of Grinder streams before frames were sent in
+    bulk: one struct.pack and one send per channel.
+    """
+    for data in frame:
+        stream.client.send(struct.pack('{}f'.format(len(data)), *data))
+
+
+def bench_reflect_publish(segment_length=100, frames=500, clients=(1, 4, 16)):
+    """
+    Measures the aggregated throughput of reflecting playback frames
+    to several clients at once, each client served by its own thread
+    like in Server.
+    """
+    data = np.random.randn(60, 150000).astype(np.float32)
+
+    def publish_frames(stream, publish):
+        for i in range(frames):
+            start = (i*segment_length) % data.shape[1]
+            publish(stream, data[:, start:start+segment_length])
+
+    for name, publish in [('per-channel send', legacy_publish),
+                          ('single sendall', grinder.Stream.send_frame)]:
+        for n in clients:
+            streams, threads = [], []
+            for _ in range(n):
+                stream = grinder.Stream()
+                stream.enable_reflector_mode()
+                stream.client, remote = socket.socketpair()
+                threading.Thread(target=drain_socket, args=(remote,), daemon=True).start()
+                streams.append(stream)
+                threads.append(threading.Thread(target=publish_frames, args=(stream, publish)))
+
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+
+            for stream in streams:
+                stream.client.close()
+            report('Reflect, {}, {} clients'.format(name, n),
+                   n*frames*60*segment_length, elapsed)
+
+
+def bench_block_reading(h5_file, blocks=3):
+    """
+    Compares reading 15 second blocks of all channels through McsPy,
+    one channel at a time, against a single read_range call.
+    """
+    if not os.path.isfile(h5_file):
+        print('Skipping block reading benchmark, {} does not exist'.format(h5_file))
+        return
+
+    exp = experiment.Experiment(h5_file)
+    length = exp.block_length
+
+    def read_mcspy(start):
+        for ch in range(exp.channels):
+            exp.get_channel_in_range(ch, start, start + length - 1)
+
+    def read_direct(start):
+        exp.read_range(start, start + length)
+
+    for name, read in [('McsPy, per channel', read_mcspy),
+                       ('Experiment.read_range', read_direct)]:
+        start = time.perf_counter()
+        for i in range(blocks):
+            read(i * length)
+        elapsed = time.perf_counter() - start
+        report('Block reading, {}'.format(name), blocks*length*exp.channels, elapsed)
+
+
+def bench_concurrent_playback(h5_file, stream_counts=(1, 4), rounds=3, replay_time=1.5):
+    """
+    Measures how long PlaybackStreams replaying the same recording at
+    different offsets wait for their next block when switching to it,
+    i.e. how well the background prefetch hides reading blocks once
+    several streams share the block cache. Replaying a block is
+    shortened to <replay_time> seconds. Synthetic data is used if
+    <h5_file> does not exist.
+    """
+    for count in stream_counts:
+        recording = h5_file
+        if not os.path.isfile(h5_file):
+            recording = 'synthetic:seconds=300,seed={}'.format(count)
+
+        # Every stream starts two blocks after the previous one.
+        streams = [grinder.PlaybackStream(None, 0, active_experiment=recording) for _ in range(count)]
+        for i, stream in enumerate(streams):
+            for _ in range(2*i + 1):
+                stream.get_tick_data()
+        time.sleep(replay_time)
+
+        waits = []
+        for _ in range(rounds):
+            for stream in streams:
+                start = time.perf_counter()
+                stream.get_tick_data()
+                waits.append(time.perf_counter() - start)
+            time.sleep(replay_time)
+
+        print('{:<40} {:>10.2f} ms mean {:>10.2f} ms max'.format(
+              'Block switch, {} concurrent streams'.format(count),
+              np.mean(waits)*1000, np.max(waits)*1000))
+
+
+def bench_mock_encoding(ticks=1000, data_per_tick=100):
+    """
+    Compares encoding the mock data for every tick (the way the mock
+    used to) against sending slices of data encoded once at startup,
+    in ticks per second. A tick of real time is 10 ms, so 100 ticks/s
+    are needed to keep up with MEAME.
+    """
+    conversion_constant = experiment.Experiment.conversion_constant
+    data = {i: np.random.randn(ticks*data_per_tick) * 1e-5 for i in range(60)}
+
+    def legacy_tick(s, tick):
+        for i in range(60):
+            counts = [int(x / conversion_constant) for x in
+                      data[i][tick*data_per_tick:(tick+1)*data_per_tick]]
+            s.send(struct.pack('<{}i'.format(len(counts)), *counts))
+
+    counts = (np.array([data[i] for i in range(60)]) / conversion_constant).astype('<i4')
+    wire_data = np.ascontiguousarray(counts.reshape(60, ticks, data_per_tick).transpose(1, 0, 2))
+
+    def wire_tick(s, tick):
+        s.sendall(memoryview(wire_data[tick]))
+
+    for name, send_tick in [('encoded per tick', legacy_tick),
+                            ('encoded at startup', wire_tick)]:
+        s, remote = socket.socketpair()
+        threading.Thread(target=drain_socket, args=(remote,), daemon=True).start()
+
+        start = time.perf_counter()
+        for tick in range(ticks):
+            send_tick(s, tick)
+        elapsed = time.perf_counter() - start
+
+        s.close()
+        print('{:<40} {:>10.3f} s {:>14,.0f} ticks/s'.format('Mock, {}'.format(name), elapsed, ticks / elapsed))
+
+
+def bench_mock_startup(h5_file, port=12345, http_port=8889):
+    """
+    Measures the time from starting a mock until a client has
+    received its first frame of data. Synthetic data is used if
+    <h5_file> does not exist.
+    """
+    recording = h5_file
+    if not os.path.isfile(h5_file):
+        recording = 'synthetic:seconds=300'
+
+    start = time.perf_counter()
+    meame_mock = mock.MEAMEMock(port, recording=recording, http_port=http_port)
+    mock_thread = sthread.StoppableThread(target=meame_mock.run)
+    mock_thread.start()
+
+    meame = meamer.MEAMEr('localhost')
+    meame.mea_daq_port = port
+    meame.initialize_DAQ(sample_rate=10000, segment_length=1000)
+    while True:
+        try:
+            meame.enable_DAQ_listener()
+            break
+        except UnresponsiveMEAMEError:
+            time.sleep(0.01)
+    meame.recv_frame()
+    elapsed = time.perf_counter() - start
+
+    meame.disable_DAQ_listener()
+    mock_thread.stop()
+    with socket.create_connection(('localhost', port)):
+        pass
+    mock_thread.join()
+    print('{:<40} {:>10.3f} s'.format('Mock startup to first frame', elapsed))
+
+
+def bench_synthetic_generation(sample_rates=(10000, 25000, 50000, 100000), seconds=5):
+    """
+    Measures how fast synthetic data of 60 channels is generated at
+    different sample rates, relative to real time.
+    """
+    for sample_rate in sample_rates:
+        exp = synthetic.SyntheticExperiment(sample_rate=sample_rate, seconds=seconds, stim_rate=1)
+        start = time.perf_counter()
+        exp.read_range(0, exp.samples)
+        elapsed = time.perf_counter() - start
+        print('{:<40} {:>10.3f} s {:>14,.0f} samples/s {:>8.1f}x real time'.format(
+              'Synthetic data, {} Hz'.format(sample_rate), elapsed,
+              exp.samples*exp.channels / elapsed, seconds / elapsed))
+
+
+def count_matches(positions, targets, slack):
+    """
+    Counts the <positions> which lie within <slack> samples of any of
+    the sorted <targets>.
+    """
+    if len(targets) == 0:
+        return 0
+    nearest = np.searchsorted(targets, positions)
+    before = targets[np.clip(nearest - 1, 0, len(targets) - 1)]
+    after = targets[np.clip(nearest, 0, len(targets) - 1)]
+    distance = np.minimum(np.abs(positions - before), np.abs(after - positions))
+    return np.count_nonzero(distance <= slack)
+
+
+def bench_spike_detection(seconds=10, tolerance=0.5e-3):
+    """
+    Scores threshold based spike detection against the ground truth
+    of synthetic data, as the share of true spikes found (recall) and
+    the share of detections that are true spikes (precision). A
+    detection matches a spike on the same channel within <tolerance>
+    seconds.
+    """
+    for stim_rate in [0, 1]:
+        exp = synthetic.SyntheticExperiment(seconds=seconds, stim_rate=stim_rate)
+        data = exp.read_range(0, exp.samples)
+        true_channels, true_positions = exp.spikes(0, exp.samples)
+        slack = int(tolerance * exp.sample_rate)
+
+        start = time.perf_counter()
+        found, correct, detections = 0, 0, 0
+        for ch in range(exp.channels):
+            # Threshold at 5 times the noise level, estimated from the
+            # median absolute deviation like in spike sorters.
+            threshold = 5 * np.median(np.abs(data[ch])) / 0.6745
+            peaks = dp.detect_peaks(data[ch], mph=-threshold, mpd=exp.spike_pre, valley=True)
+            truth = true_positions[true_channels == ch]
+            found += count_matches(truth, peaks, slack)
+            correct += count_matches(peaks, truth, slack)
+            detections += len(peaks)
+        elapsed = time.perf_counter() - start
+
+        print('{:<40} {:>10.3f} s {:>9.1%} recall {:>9.1%} precision'.format(
+              'Spike detection, {} Hz stimuli'.format(stim_rate), elapsed,
+              found / len(true_positions), correct / max(detections, 1)))
+
+
+def bench_cleaviz_redraw(frames=90, fps=30):
+    """
+    Measures the cost of redrawing 3 seconds of all 60 channels in
+    Cleaviz, with every channel in a plot of its own and with all
+    channels batched into a single plot. A redraw has to take less
+    than 1/<fps> seconds to keep up with <fps> frames per second.
+    """
+    app = pg.mkQApp()
+    exp = synthetic.SyntheticExperiment(seconds=3)
+    data = exp.read_range(0, exp.samples)
+
+    for name, batched in [('separate plots', False), ('batched plot', True)]:
+        win = cleaviz.CleavizWindow(sample_rate=exp.sample_rate, segment_length=1000, batched=batched)
+        win.channel_data.write(data)
+        redraw = win.update_batched_plot if batched else win.update_grid_plots
+        app.processEvents()
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            redraw()
+            win.viewport().repaint()
+        elapsed = time.perf_counter() - start
+
+        win.close()
+        print('{:<40} {:>10.2f} ms/frame {:>9.0%} of {} FPS'.format(
+              'Cleaviz redraw, {}'.format(name), elapsed/frames*1000, elapsed/frames*fps, fps))
+
+
+def bench_incremental_stft(seconds=3, segment_length=100, segments=1000):
+    """
+    Compares the cost per received segment of keeping a spectrogram
+    of the last <seconds> seconds of a channel up to date, by
+    recomputing the whole STFT for every segment and by only
+    transforming the windows each segment completes.
+    """
+    exp = synthetic.SyntheticExperiment(seconds=seconds + segments*segment_length/10000)
+    data = exp.read_range(0, exp.samples)[0]
+    window = int(seconds * exp.sample_rate)
+
+    start = time.perf_counter()
+    for i in range(segments):
+        end = window + i*segment_length
+        stft(data[end-window:end], fs=exp.sample_rate, window='hamming', nperseg=500, noverlap=400)
+    full = (time.perf_counter() - start) / segments
+
+    incremental_stft = analysis.IncrementalSTFT(exp.sample_rate, num_buckets=50)
+    incremental_stft.update(data[:window])
+    start = time.perf_counter()
+    for i in range(segments):
+        end = window + i*segment_length
+        incremental_stft.update(data[end:end+segment_length])
+    incremental = (time.perf_counter() - start) / segments
+
+    for name, elapsed in [('full', full), ('incremental', incremental)]:
+        print('{:<40} {:>10.3f} ms/segment'.format('STFT of {} s, {}'.format(seconds, name), elapsed*1000))
+
+
+def bench_frame_detector(segments=100):
+    """
+    Measures the cost of a decision of the closed loop over whole 60
+    channel frames of 100 ms, with rules on every feature. A decision
+    has to take less than a segment to keep up with the stream.
+    """
+    exp = synthetic.SyntheticExperiment(seconds=segments*0.1, stim_rate=1)
+    data = exp.read_range(0, exp.samples)
+    segment_length = exp.sample_rate // 10
+    everything = list(range(exp.channels))
+    detector = demo_receiver.FrameDetector(exp.sample_rate, rules=[
+        demo_receiver.KOfNRule('sma', 1e-5, 10, everything),
+        demo_receiver.KOfNRule('peak_count', 1, 30, everything),
+        demo_receiver.KOfNRule('band_power', 1e-9, 30, everything)])
+
+    start = time.perf_counter()
+    positives = 0
+    for i in range(segments):
+        positives += detector.decide(data[:, i*segment_length:(i+1)*segment_length])
+    elapsed = (time.perf_counter() - start) / segments
+
+    print('{:<40} {:>10.3f} ms/segment {:>9.1%} of a segment ({:.0f} positive)'.format(
+          'Frame detector, 60 channels', elapsed*1000, elapsed / 0.1, positives))
+
+
+def main(args):
+    if args.decode or args.all:
+        bench_segment_decoding()
+        bench_frame_decoding()
+    if args.publish or args.all:
+        bench_reflect_publish()
+    if args.mock or args.all:
+        bench_mock_encoding()
+    if args.read or args.all:
+        bench_block_reading(args.experiment)
+        bench_concurrent_playback(args.experiment)
+    if args.startup or args.all:
+        bench_mock_startup(args.experiment)
+    if args.synthetic or args.all:
+        bench_synthetic_generation()
+        bench_spike_detection()
+    if args.redraw or args.all:
+        bench_cleaviz_redraw()
+    if args.stft or args.all:
+        bench_incremental_stft()
+    if args.detector or args.all:
+        bench_frame_detector()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks for the SiNRI data paths')
+
+    parser.add_argument('--all', help='Run all benchmarks', action='store_true')
+    parser.add_argument('--decode', help='Benchmark decoding of DAQ segments and frames in MEAMEr', action='store_true')
+    parser.add_argument('--publish', help='Benchmark reflecting frames to Grinder clients', action='store_true')
+    parser.add_argument('--mock', help='Benchmark encoding of mock data', action='store_true')
+    parser.add_argument('--startup', help='Benchmark startup time of the mock', action='store_true')
+    parser.add_argument('--synthetic', help='Benchmark generation of synthetic data and spike detection on it', action='store_true')
+    parser.add_argument('--redraw', help='Benchmark redrawing all channels in Cleaviz', action='store_true')
+    parser.add_argument('--stft', help='Benchmark updating a spectrogram with every segment', action='store_true')
+    parser.add_argument('--detector', help='Benchmark closed-loop decisions over whole frames', action='store_true')
+    parser.add_argument('--read', help='Benchmark reading blocks from a recording', action='store_true')
+    parser.add_argument('--experiment', help='Recording used for the benchmarks', default='mea_data/1.h5')
+
+    args = parser.parse_args()
+    main(args)
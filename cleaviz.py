@@ -1,15 +1,16 @@
 import log
 logger = log.get_logger(__name__)
 
+import analysis
 import channelconverter as chconv
 import socket
-import struct
 import PyQt5
 import pyqtgraph as pg
 import scipy.signal
 import datetime
 import json
 import numpy as np
+import ring
 import threading
 import sthread
 import time
@@ -29,13 +30,23 @@ if not os.name == 'nt':
 # that parameters may be tuned.
 
 
-def sync_watchdog(s, sample_rate):
+def socket_backlog(s):
+    """
+    Returns the amount of bytes ready to be read in from the socket
+    <s>, i.e. how far we are lagging behind. Always 0 on Windows,
+    where FIONREAD is not available.
+    """
     if os.name == 'nt':
-        return
+        return 0
 
-    # Used to see how much data is ready to be read in from the socket
-    # (to see if we are lagging behind).
     sock_size = array.array('i', [0])
+    fcntl.ioctl(s, termios.FIONREAD, sock_size)
+    return sock_size[0]
+
+
+def sync_watchdog(s, sample_rate):
+    if os.name == 'nt':
+        return
 
     # After every segment, check if we still have data to be
     # received -- this signifies that we are not keeping up
@@ -46,9 +57,9 @@ def sync_watchdog(s, sample_rate):
         if current_thread.stopped():
             return
 
-        fcntl.ioctl(s, termios.FIONREAD, sock_size)
-        if (sock_size[0] // 4 >= 20*sample_rate):
-            logger.info('{s} data available in TCP socket'.format(s=sock_size[0]))
+        backlog = socket_backlog(s)
+        if (backlog // 4 >= 20*sample_rate):
+            logger.info('{s} data available in TCP socket'.format(s=backlog))
             logger.info('Cleaviz is struggling to keep up with the data rate')
         time.sleep(1)
 
@@ -70,13 +81,126 @@ def downsample(x, ds):
     what MCS does quite nicely. <x> is the data, while <ds> is the
     downsampling rate.
     """
-    n = len(x) // ds
-    new1 = np.empty((n, 2))
-    new2 = np.array(x[:n*ds]).reshape((n, ds))
-    new1[:, 0] = new2.max(axis=1)
-    new1[:, 1] = new2.min(axis=1)
-    x = new1.reshape(n*2)
-    return x
+    return downsample_frame(np.asarray(x)[np.newaxis], ds)[0]
+
+
+def downsample_frame(x, ds):
+    """
+    Downsamples all channels of <x>, a (channels, samples) array, at
+    once. The min and max of every window of <ds> samples are found
+    with a single NumPy reduction each, over all channels.
+    """
+    channels, n = x.shape[0], x.shape[1] // ds
+    windows = x[:, :n*ds].reshape((channels, n, ds))
+    out = np.empty((channels, n, 2), dtype=x.dtype)
+    windows.max(axis=2, out=out[:, :, 0])
+    windows.min(axis=2, out=out[:, :, 1])
+    return out.reshape((channels, n*2))
+
+
+def downsampling_rate(samples, pixels):
+    """
+    Picks the downsampling rate that leaves roughly one min/max pair
+    per pixel when <samples> samples are drawn <pixels> pixels wide.
+    Data that already fits is not downsampled at all (a rate of 1).
+    """
+    return max(int(samples // max(pixels, 1)), 1)
+
+
+class EnvelopePyramid(object):
+    """
+    The history of <channels> channels at several resolutions, like a
+    mipmap. Level 0 holds the latest <length> samples at full rate,
+    while every following level holds <length> values of min/max pairs
+    over windows <factor> times longer than those of the level before.
+    Levels are added until the coarsest one spans <history> samples,
+    such that minutes of history only take a few times the memory of
+    the full rate level. Every level is a ChannelRing, which stores its
+    values twice: 3 s at full rate and 5 minutes of history of 60
+    channels at 10 kHz take 4 levels, or about 58 MB.
+    """
+    def __init__(self, channels, length, history, factor=8, dtype=np.float32):
+        self.factor = factor
+        self.levels = [ring.ChannelRing(channels, length, dtype=dtype)]
+        self.tails = [None]
+
+        # Samples of the original data per value in each level, where
+        # every min/max pair takes up two values.
+        self.spacing = [1]
+        while length * self.spacing[-1] < history:
+            self.levels.append(ring.ChannelRing(channels, length, dtype=dtype))
+            self.tails.append(np.empty((channels, 0), dtype=dtype))
+            self.spacing.append(factor**(len(self.levels) - 1) / 2)
+        self.lock = threading.Lock()
+
+
+    def write(self, samples):
+        """
+        Appends the (channels, samples) array <samples> to all levels.
+        Values that do not fill a whole window of the next level are
+        held back until the next write.
+        """
+        with self.lock:
+            self.levels[0].write(samples)
+            values = samples
+            for level in range(1, len(self.levels)):
+                ds = self.factor if level == 1 else 2*self.factor
+                values = np.concatenate([self.tails[level], values], axis=1)
+                complete = values.shape[1] // ds * ds
+                self.tails[level] = values[:, complete:]
+                if complete == 0:
+                    break
+                values = downsample_frame(values[:, :complete], ds)
+                self.levels[level].write(values)
+
+
+    def written(self):
+        return self.levels[0].written
+
+
+    def oldest(self, level):
+        """
+        Returns the index of the oldest value held by <level>.
+        """
+        return self.levels[level].written - min(self.levels[level].written, self.levels[level].length)
+
+
+    def envelope(self, channel, start, stop, pixels):
+        """
+        Returns the positions (in samples) and values to draw for
+        <channel> from sample <start> to <stop>, <pixels> pixels wide.
+        Data is taken from the coarsest level which still has two
+        values per pixel, among the levels reaching back to <start>,
+        and downsampled further to about one min/max pair per pixel.
+        """
+        with self.lock:
+            stop = min(stop, self.written())
+            covering = [level for level in range(len(self.levels))
+                        if self.oldest(level) * self.spacing[level] <= start]
+            covering = covering or [len(self.levels) - 1]
+            detailed = [level for level in covering
+                        if (stop - start) / self.spacing[level] >= 2*pixels]
+            level = max(detailed) if detailed else min(covering)
+
+            spacing, oldest = self.spacing[level], self.oldest(level)
+            first = max(int(start // spacing), oldest)
+            last = min(int(-(-stop // spacing)), self.levels[level].written)
+
+            # Downsample in whole pairs, aligned to the start of the
+            # data, so that the drawn envelope does not flicker while
+            # the view is moved.
+            ds = downsampling_rate(last - first, 2*pixels)
+            if level > 0 and ds > 1:
+                ds += ds % 2
+            first -= first % ds
+            if first < oldest:
+                first += ds
+            values = self.levels[level].latest()[channel, first-oldest:max(last, first)-oldest].copy()
+
+        if ds > 1:
+            values = downsample_frame(values[np.newaxis], ds)[0]
+            spacing = spacing * ds / 2
+        return first * self.spacing[level] + np.arange(len(values)) * spacing, values
 
 
 def init_plots(win, rows, cols):
@@ -101,10 +225,58 @@ def init_plots(win, rows, cols):
     return plots, plot_objects
 
 
+def init_batched_plot(win, rows, cols):
+    """
+    Setup a single pyqtgraph plot to draw all channels in, laid out
+    like the MEA grid. The cell at row <i> and column <j> spans x from
+    j to j+1 and y from rows-i-1 to rows-i, such that a position in
+    the plot maps straight to a channel through mcs_lookup.
+    """
+    plot = win.addPlot(row=0, col=0)
+    plot.hideAxis('left')
+    plot.hideAxis('bottom')
+    plot.hideButtons()
+    plot.setMouseEnabled(x=False, y=False)
+    plot.setXRange(0, cols, padding=0)
+    plot.setYRange(0, rows, padding=0)
+    curve = plot.plot(pen=pg.mkPen('#EB9904'))
+    return plot, curve
+
+
+def channel_cells(rows, cols):
+    """
+    Returns the grid row and column of every channel.
+    """
+    cells = np.zeros((60, 2), dtype=int)
+    for i in range(rows):
+        for j in range(cols):
+            channel = mcs_lookup(i+1, j+1)
+            if channel != -1:
+                cells[channel] = (i, j)
+    return cells
+
+
 class CleavizWindow(pg.GraphicsWindow):
+    """
+    Plots all 60 channels of a reflected Grinder stream. Segments are
+    received on a thread of their own, while the plots are redrawn
+    from a snapshot of the latest data <fps> times a second, such that
+    neither network stalls nor slow drawing hold up the other.
+
+    <history> minutes of data are kept, which can be panned through
+    and zoomed into after clicking a channel. The latest
+    <full_rate_seconds> (at least what the main view shows) are kept
+    at full rate, and older data only as min/max envelopes.
+
+    If <batched>, all channels are drawn as a single curve in a single
+    plot, instead of in 60 plots of their own. A zoomed in channel is
+    shown together with a live spectrogram of it.
+    """
     sig_key_press = pg.Qt.QtCore.pyqtSignal(object)
+    sig_receiver_stopped = pg.Qt.QtCore.pyqtSignal()
 
-    def __init__(self, sample_rate, segment_length, *args, **kwargs):
+    def __init__(self, sample_rate, segment_length, *args, fps=30, history=5, full_rate_seconds=3,
+                 batched=True, **kwargs):
         super().__init__(*args, **kwargs)
 
         # Hard code these for now, use argparse maybe later? We are just
@@ -121,79 +293,264 @@ class CleavizWindow(pg.GraphicsWindow):
         self.sample_rate = sample_rate
         self.segment_length = segment_length
         self.seconds = 3
-        self.data_in_window = self.sample_rate*self.seconds // 10
+        self.data_in_window = self.sample_rate*self.seconds
+        self.history = history
+        self.full_rate_seconds = max(full_rate_seconds, self.seconds)
+
+        # Buffers for a received segment of all channels and the
+        # snapshot being plotted, allocated once and reused. Data is
+        # kept at full rate, and only downsampled when drawn.
+        self.frame = np.empty((60, self.segment_length), dtype=np.float32)
+        self.plot_data = np.empty((60, self.data_in_window), dtype=np.float32)
+        self.channel_data = EnvelopePyramid(60, int(self.sample_rate*self.full_rate_seconds),
+                                            self.sample_rate*self.history*60)
+
+        # Redrawing is driven by a timer, and is independent of the
+        # rate at which segments arrive.
+        self.fps = fps
+        self.redraw_timer = pg.QtCore.QTimer()
+        self.redraw_timer.timeout.connect(self.update_plots)
+        self.redraws = 0
+        self.segments_received = 0
+        self.last_status = (time.monotonic(), 0, 0)
 
         # Initialize the plots of the main window.
         self.rows = 8
         self.cols = 8
-        self.plots, self.plot_objects = init_plots(self, self.rows, self.cols)
+        self.batched = batched
+        if self.batched:
+            self.grid_plot, self.grid_curve = init_batched_plot(self, self.rows, self.cols)
+            self.cells = channel_cells(self.rows, self.cols)
+            self.grid_layout = None
+        else:
+            self.plots, self.plot_objects = init_plots(self, self.rows, self.cols)
         self.zoomed_plot = None
         self.zoomed_plot_num = None
+        self.zoomed_curve = None
+        self.follow_live = True
+        self.spectrogram = None
+        self.spectrogram_plot = None
 
         # Connect mouse/key signals to respective handlers.
         self.scene().sigMouseClicked.connect(self.on_click)
         self.keyPressEvent = self.on_key_press
         self.closeEvent = self.on_close
-
-        self.x_axis_data = np.arange(self.data_in_window)
+        self.event_loop = pg.QtCore.QEventLoop()
+        self.sig_receiver_stopped.connect(self.event_loop.quit)
 
 
     def recv_segment(self):
         """
-        Receives a single segment from an incoming stream in a socket.
+        Receives a single segment of all channels from an incoming
+        stream in a socket. The 4-byte floats are received straight
+        into a preallocated frame, which is written to the channel
+        history in place.
         """
-        bytes_received = 0
-        segment_data = bytearray(b'')
         self.s.settimeout(3.0)
 
-        for current_channel in range(60):
-            while True:
-                # We are receiving 4-byte floats.
-                data = self.s.recv(self.segment_length*4 - bytes_received)
-                bytes_received = bytes_received + len(data)
-                segment_data = np.append(segment_data, data)
-
-                if (bytes_received != self.segment_length*4):
-                    continue
-                else:
-                    break
+        view = memoryview(self.frame).cast('B')
+        while view:
+            bytes_received = self.s.recv_into(view)
+            if bytes_received == 0:
+                raise ConnectionResetError('Remote grinder closed the connection')
+            view = view[bytes_received:]
 
-            # Print the received segment data.
-            new_channel_data = []
+        self.channel_data.write(self.frame)
+        self.segments_received += 1
 
-            for i in struct.iter_unpack('f', segment_data):
-                new_channel_data.append(i[0])
-            new_channel_data = downsample(new_channel_data, 20)
+        # The spectrogram of the zoomed in channel is computed as the
+        # data arrives, such that it is only ever computed once.
+        spectrogram = self.spectrogram
+        if spectrogram is not None:
+            channel, stft, columns = spectrogram
+            columns.write(stft.update(self.frame[channel]))
 
-            self.channel_data[current_channel] = np.append(self.channel_data[current_channel], new_channel_data)
-            self.channel_data[current_channel] = self.channel_data[current_channel][-self.data_in_window:]
 
-            # Reset for next segment.
-            segment_data = bytearray(b'')
-            bytes_received = 0
+    def receive(self):
+        """
+        Receives segments into the channel history until stopped or
+        the stream ends, which also ends the event loop of run.
+        """
+        while not sthread.check_terminate_thread():
+            try:
+                self.recv_segment()
+            except socket.timeout as e:
+                logger.info('Cleaviz timed during data receive, exiting')
+                break
+            except (ConnectionResetError, OSError) as e:
+                if not sthread.check_terminate_thread():
+                    logger.info('Remote grinder closed the connection, exiting')
+                break
+        self.sig_receiver_stopped.emit()
 
 
     def update_plots(self):
-        # Data to plot.
-        x_axis_data = self.x_axis_data[:len(self.channel_data[0])]
-
         if self.zoomed_plot:
-            self.zoomed_plot.plot(x_axis_data, self.channel_data[self.zoomed_plot_num],
-                                  pen=pg.mkPen('#EB9904'), clear=True)
-            pg.QtGui.QApplication.processEvents()
+            self.update_zoomed_plot()
+        elif self.batched:
+            self.update_batched_plot()
         else:
-            for i in range(self.rows):
-                for j in range(self.cols):
-                    channel = mcs_lookup(i+1, j+1)
-                    if channel != -1:
-                        self.plots[channel].setData(x=x_axis_data, y=self.channel_data[channel])
-            pg.QtGui.QApplication.processEvents()
+            self.update_grid_plots()
+
+        self.redraws += 1
+        self.update_status()
+
+
+    def update_grid_plots(self):
+        # Data to plot, as a snapshot of the channel history such that
+        # receiving may go on while drawing.
+        n = self.channel_data.levels[0].copy_latest(self.plot_data)
+        channel_data = self.plot_data[:, :n]
+
+        # Downsample to about one min/max pair per pixel of the plots.
+        ds = downsampling_rate(n, self.plot_objects[mcs_lookup(1, 2)].getViewBox().width())
+        if ds > 1:
+            channel_data = downsample_frame(channel_data, ds)
+        x_axis_data = np.arange(channel_data.shape[1]) * (ds / min(ds, 2))
+
+        for i in range(self.rows):
+            for j in range(self.cols):
+                channel = mcs_lookup(i+1, j+1)
+                if channel != -1:
+                    self.plots[channel].setData(x=x_axis_data, y=channel_data[channel])
+
+
+    def update_batched_plot(self):
+        """
+        Draws all channels into their cells of the single grid plot,
+        as one curve. The curve is split into channels by a connect
+        array, and data is scaled to the current y-range and offset
+        into its cell, all at once for every channel.
+        """
+        n = self.channel_data.levels[0].copy_latest(self.plot_data)
+        channel_data = self.plot_data[:, :n]
+        if n == 0:
+            return
+
+        ds = downsampling_rate(n, self.grid_plot.getViewBox().width() / self.cols)
+        if ds > 1:
+            channel_data = downsample_frame(channel_data, ds)
+        points = channel_data.shape[1]
+
+        # The x positions and connect array only change with the
+        # amount of points drawn, and are cached in between.
+        if self.grid_layout is None or self.grid_layout[0] != (points, ds):
+            x_step = (ds / min(ds, 2)) / self.data_in_window
+            x = self.cells[:, 1, np.newaxis] + 0.05 + 0.9*x_step*np.arange(points)
+            connect = np.ones((60, points), dtype=bool)
+            connect[:, -1] = False
+            y_offset = (self.rows - self.cells[:, 0, np.newaxis] - 0.5).astype(np.float32)
+            self.grid_layout = ((points, ds), x.ravel(), connect.ravel(), y_offset)
+        _, x, connect, y_offset = self.grid_layout
+
+        scale = 0.45 / self.current_yrange
+        y = np.clip(channel_data, -self.current_yrange, self.current_yrange) * scale + y_offset
+        self.grid_curve.setData(x=x, y=y.ravel(), connect=connect)
+
+
+    def channel_at(self, scene_pos):
+        """
+        Returns the channel drawn at <scene_pos> in the grid, or -1 if
+        there is none, by mapping the position to its grid cell.
+        """
+        if self.batched:
+            pos = self.grid_plot.getViewBox().mapSceneToView(scene_pos)
+            row, col = self.rows - 1 - int(np.floor(pos.y())), int(np.floor(pos.x()))
+        else:
+            clicked_items = self.scene().items(scene_pos)
+            try:
+                plot = [x for x in clicked_items if isinstance(x, pg.PlotItem)][0]
+            except IndexError:
+                return -1
+            row, col = self.ci.items[plot][0]
+
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            return -1
+        return mcs_lookup(row+1, col+1)
+
+
+    def update_zoomed_plot(self):
+        """
+        Draws the part of the history within the view of the zoomed in
+        plot, in seconds since the stream started. The view follows
+        the newest data, unless it has been panned back in time.
+        """
+        view = self.zoomed_plot.getViewBox()
+        newest = self.channel_data.written() / self.sample_rate
+        start, stop = view.viewRange()[0]
+        if stop >= newest:
+            self.follow_live = True
+        if self.follow_live:
+            start, stop = newest - (stop - start), newest
+            view.setXRange(start, stop, padding=0)
+
+        x_axis_data, channel_data = self.channel_data.envelope(
+            self.zoomed_plot_num, int(start*self.sample_rate), int(stop*self.sample_rate), view.width())
+        self.zoomed_curve.setData(x=x_axis_data / self.sample_rate, y=channel_data)
+        self.update_spectrogram(newest)
+
+
+    def init_spectrogram(self, channel):
+        """
+        Starts computing the spectrogram of <channel>, and adds a plot
+        of the last <seconds> seconds of it below the zoomed in plot.
+        """
+        stft = analysis.IncrementalSTFT(self.sample_rate, nperseg=500, noverlap=400, num_buckets=50)
+        columns = self.seconds * self.sample_rate // stft.hop
+        self.spectrogram_data = np.empty((stft.num_buckets, columns), dtype=np.float32)
+        self.spectrogram = (channel, stft, ring.ChannelRing(stft.num_buckets, columns))
+
+        self.spectrogram_plot = self.addPlot(row=1, col=0)
+        self.spectrogram_plot.setMouseEnabled(x=False, y=False)
+        self.spectrogram_plot.setLabel('left', 'Hz')
+        self.spectrogram_plot.setYRange(0, stft.frequencies[-1], padding=0)
+        self.spectrogram_image = pg.ImageItem(axisOrder='row-major')
+        colors = pg.ColorMap([0, 0.5, 1], [(0x35, 0x35, 0x35), (0xEB, 0x99, 0x04), (255, 255, 255)])
+        self.spectrogram_image.setLookupTable(colors.getLookupTable())
+        self.spectrogram_plot.addItem(self.spectrogram_image)
+
+
+    def update_spectrogram(self, newest):
+        """
+        Draws the log magnitudes of the spectrogram, with its newest
+        column at <newest> seconds.
+        """
+        _, stft, columns = self.spectrogram
+        n = columns.copy_latest(self.spectrogram_data)
+        if n == 0:
+            return
+
+        span = n * stft.hop / self.sample_rate
+        self.spectrogram_image.setImage(np.log10(self.spectrogram_data[:, :n] + 1e-12))
+        self.spectrogram_image.setRect(pg.QtCore.QRectF(newest - span, 0, span, stft.frequencies[-1]))
+        self.spectrogram_plot.setXRange(newest - self.seconds, newest, padding=0)
+
+
+    def on_pan(self, *args):
+        self.follow_live = False
+
+
+    def update_status(self):
+        """
+        Shows the achieved frame rate, the rate of received samples
+        and how far behind the stream we are in the window title, once
+        a second.
+        """
+        now = time.monotonic()
+        then, redraws, segments = self.last_status
+        if now - then < 1:
+            return
+
+        fps = (self.redraws - redraws) / (now - then)
+        sample_rate = (self.segments_received - segments) * self.segment_length / (now - then)
+        lag = socket_backlog(self.s) / (4 * 60 * self.sample_rate)
+        self.setWindowTitle('Cleaviz - {fps:.0f} FPS, {rate:.0f} samples/s, {lag:.0f} ms behind'.
+                            format(fps=fps, rate=sample_rate, lag=lag*1000))
+        self.last_status = (now, self.redraws, self.segments_received)
 
 
     def run(self):
         self.running = True
-        self.channel_data = {n: np.array([]) for n in range(60)}
-        segment_counter = 0
 
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as self.s:
             try:
@@ -206,22 +563,23 @@ class CleavizWindow(pg.GraphicsWindow):
             self.watchdog = sthread.StoppableThread(target=sync_watchdog, args=([self.s, self.sample_rate]))
             self.watchdog.start()
 
-            segment_mod = (1000 // self.segment_length - 0)
-            while True:
-                if not self.running:
-                    return
+            self.receiver = sthread.StoppableThread(target=self.receive)
+            self.receiver.start()
+            self.redraw_timer.start(1000 // self.fps)
 
-                try:
-                    self.recv_segment()
-                except socket.timeout as e:
-                    logger.info('Cleaviz timed during data receive, exiting')
-                    self.watchdog.stop()
-                    self.watchdog.join()
-                    return
+            # Runs until the window is closed or the stream ends.
+            if self.running:
+                self.event_loop.exec_()
 
-                segment_counter = (segment_counter + 1) % segment_mod
-                if segment_counter == 0:
-                    self.update_plots()
+            self.redraw_timer.stop()
+            self.receiver.stop()
+            self.watchdog.stop()
+            try:
+                self.s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.receiver.join()
+            self.watchdog.join()
 
 
     def on_click(self, event):
@@ -231,29 +589,35 @@ class CleavizWindow(pg.GraphicsWindow):
 
         if self.zoomed_plot:
             self.zoomed_plot = None
+            self.zoomed_curve = None
+            self.spectrogram = None
+            self.spectrogram_plot = None
 
-            # Go back to plotting all channels.
+            # Go back to plotting all channels. The batched grid plot
+            # is kept around, and is simply put back.
             self.clear()
-            self.plots, self.plot_objects = init_plots(self, self.rows, self.cols)
+            if self.batched:
+                self.addItem(self.grid_plot, row=0, col=0)
+            else:
+                self.plots, self.plot_objects = init_plots(self, self.rows, self.cols)
         else:
-            clicked_items = self.scene().items(event.scenePos())
-
-            try:
-                self.zoomed_plot = [x for x in clicked_items if isinstance(x, pg.PlotItem)][0]
-            except IndexError:
+            channel = self.channel_at(event.scenePos())
+            if channel == -1:
                 return
+            self.zoomed_plot_num = channel
 
-            x_axis = self.zoomed_plot.items[0].xData
-            y_axis = self.zoomed_plot.items[0].yData
-            for i, plot in enumerate(self.plots):
-                if np.array_equal(self.zoomed_plot.items[0].yData, plot.yData):
-                    self.zoomed_plot_num = i
-
-            # Add a new, singular plot to the window (zoomed in).
+            # Add a new, singular plot to the window (zoomed in), which
+            # is panned and zoomed along the time axis with the mouse.
             self.clear()
-            self.zoomed_plot = self.addPlot()
-            self.zoomed_plot.plot(x_axis, y_axis, pen=pg.mkPen('#EB9904'), clear=True)
+            self.zoomed_plot = self.addPlot(row=0, col=0)
+            self.zoomed_plot.setMouseEnabled(x=True, y=False)
             self.zoomed_plot.setYRange(-self.current_yrange, self.current_yrange, padding=0)
+            newest = self.channel_data.written() / self.sample_rate
+            self.zoomed_plot.setXRange(newest - self.seconds, newest, padding=0)
+            self.zoomed_plot.getViewBox().sigRangeChangedManually.connect(self.on_pan)
+            self.zoomed_curve = self.zoomed_plot.plot(pen=pg.mkPen('#EB9904'))
+            self.follow_live = True
+            self.init_spectrogram(channel)
 
 
     def on_key_press(self, event):
@@ -262,17 +626,17 @@ class CleavizWindow(pg.GraphicsWindow):
         elif event.text() == 'k':
             self.current_yrange *= 2
 
+        # The batched grid plot is scaled to the y-range when drawn.
         if self.zoomed_plot:
             self.zoomed_plot.setYRange(-self.current_yrange, self.current_yrange, padding=0)
-        else:
+        elif not self.batched:
             for plot in self.plot_objects:
                 plot.setYRange(-self.current_yrange, self.current_yrange, padding=0)
 
 
     def on_close(self, event):
-        self.watchdog.stop()
-        self.watchdog.join()
         self.running = False
+        self.event_loop.quit()
 
 
 def main(args):
@@ -282,7 +646,9 @@ def main(args):
 
     app = pg.QtGui.QApplication([])
     app.setQuitOnLastWindowClosed(True)
-    win = CleavizWindow(sample_rate=10000, segment_length=segment_length)
+    win = CleavizWindow(sample_rate=10000, segment_length=segment_length, fps=args.fps,
+                        history=args.history, full_rate_seconds=args.full_rate_seconds,
+                        batched=not args.separate_plots)
     win.run()
 
 
@@ -291,6 +657,10 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Cleaviz - visualization tool for usage with Grinder')
 
     parser.add_argument('--segment-length', help='Specify the length of the received segments')
+    parser.add_argument('--fps', help='Frame rate to redraw the plots at', type=int, default=30)
+    parser.add_argument('--separate-plots', help='Draw every channel in a plot of its own, instead of all in one', action='store_true')
+    parser.add_argument('--history', help='Minutes of data that can be looked back at', type=float, default=5)
+    parser.add_argument('--full-rate-seconds', help='Seconds of the history kept at full rate', type=float, default=3)
 
     args = parser.parse_args()
     main(args)
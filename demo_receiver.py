@@ -4,20 +4,22 @@ logger = log.get_logger(__name__)
 
 import socket
 import traceback
-import struct
 import numpy as np
 import serial
 import sthread
 import time
 import meamer
 import sthread
-import warnings
+import streamstats
+import tracing
+import channelconverter as chconv
 import threading
 
 
 sensor_distance = 1500
-sensor_distances = []
+sensor_distances = streamstats.RunningWindow(10)
 is_object_close = False
+tracer = tracing.Tracer()
 prediction_event = threading.Event()
 stimuli_state = False
 
@@ -39,99 +41,314 @@ def receive_sensor():
     Receives a single reading from the external ultrasound sensor.
     """
     global sensor_distance
-    global sensor_distances
     global is_object_close
 
     with serial.Serial('/dev/ttyUSB5') as ser:
         while True:
             sensor_distance = serial_distance(ser)
+            tracer.span('Sensor read interval', 'sensor_read')
+            read_at = tracer.mark('sensor_read')
             sensor_distances.append(1.0 if sensor_distance < 100.0 else 0.0)
-            sensor_distances = sensor_distances[-10:]
 
-            if np.mean(sensor_distances) >= 0.6:
-                is_object_close = True
-            else:
-                is_object_close = False
+            # The time of the reading that changed the state is kept,
+            # such that the latency until stimulation can be measured.
+            object_close = sensor_distances.mean() >= 0.6
+            if object_close != is_object_close:
+                tracer.mark('object_state_changed', read_at)
+                is_object_close = object_close
 
             if sthread.check_terminate_thread():
                 return
 
 
-def connect_to_grinder(verbose=True):
-    host = '0.0.0.0'
-    port = 8080
+class SegmentReader(object):
+    """
+    Reads the stream of a Grinder server at <host>:<port> as segments
+    of <segment_length> float32 samples of <channels> channels, where
+    whole 60 channel frames are received from a reflecting Grinder.
+    Segments are received with recv_into straight into a preallocated
+    buffer, and handed out as a (channels, segment_length) NumPy array
+    that is reused and overwritten by the next read.
+
+    A read that receives nothing for <timeout> seconds, or a
+    connection that fails, makes the reader reconnect, at most
+    <reconnect_attempts> times in a row with <reconnect_delay> seconds
+    in between. A partially received segment is discarded when
+    reconnecting. Grinder closing the connection ends the stream.
+    """
+    def __init__(self, host, port, segment_length, channels=1, timeout=3.0,
+                 reconnect_attempts=3, reconnect_delay=1.0):
+        self.host = host
+        self.port = port
+        self.segment_length = segment_length
+        self.channels = channels
+        self.timeout = timeout
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.s = None
+        self.segments_received = 0
+
+        self.buffer = bytearray(channels*segment_length*4)
+        self.segment = np.frombuffer(self.buffer, dtype=np.float32).reshape(channels, segment_length)
+
+
+    def __enter__(self):
+        self.connect()
+        return self
 
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((host, port))
-            run_demo(s, verbose)
-    except Exception as e:
-        logger.info('Could not connect to remote grinder instance')
-        logger.error(traceback.format_exc())
 
+    def __exit__(self, *args):
+        self.close()
 
-def receive_segment(segment_length, s):
+
+    def connect(self):
+        self.close()
+        self.s = socket.create_connection((self.host, self.port), timeout=self.timeout)
+
+
+    def close(self):
+        if self.s is not None:
+            self.s.close()
+            self.s = None
+
+
+    def reconnect(self):
+        """
+        Reconnects to Grinder, and returns whether it succeeded within
+        <reconnect_attempts> attempts.
+        """
+        for attempt in range(1, self.reconnect_attempts + 1):
+            if sthread.check_terminate_thread():
+                return False
+            time.sleep(self.reconnect_delay)
+            try:
+                self.connect()
+                logger.info('Reconnected to grinder after {n} attempt(s)'.format(n=attempt))
+                return True
+            except OSError as e:
+                logger.info('Could not reconnect to grinder ({e})'.format(e=e))
+        return False
+
+
+    def recv_exactly(self):
+        """
+        Fills the segment buffer with data from Grinder. Returns False
+        if the connection was closed before it was filled.
+        """
+        view = memoryview(self.buffer)
+        while view:
+            bytes_received = self.s.recv_into(view)
+            if bytes_received == 0:
+                return False
+            view = view[bytes_received:]
+        return True
+
+
+    def read(self):
+        """
+        Returns the next segment, or None when the stream has ended,
+        either by the connection being closed, by receiving the end of
+        stream marker of Grinder (NaN values), or by failing to
+        reconnect.
+        """
+        while True:
+            try:
+                if self.s is None:
+                    self.connect()
+                if not self.recv_exactly():
+                    return None
+                break
+            except OSError as e:
+                logger.info('Lost the grinder stream ({e}), reconnecting'.format(e=e))
+                self.close()
+                if not self.reconnect():
+                    logger.error('Giving up on grinder after {n} attempts to reconnect'.
+                                 format(n=self.reconnect_attempts))
+                    return None
+
+        if np.isnan(self.segment).any():
+            return None
+        self.segments_received += 1
+        return self.segment
+
+
+class KOfNRule(object):
     """
-    <segment_length> determines the size of each segment of the
-    interleaved stream. <s> is socket that listens for the incoming
-    stream.
+    Fires when at least <k> of the <channels> (indices into the rows
+    of a frame) have a <feature> of at least <threshold>, e.g. a peak
+    count of 2 on 3 out of 5 neighbouring electrodes.
     """
-    bytes_received = 0
-    segment_data = bytearray(b'')
-    channel_data = []
+    def __init__(self, feature, threshold, k, channels):
+        if feature not in FrameDetector.features:
+            raise ValueError('Unknown feature {f}'.format(f=feature))
+        self.feature = feature
+        self.threshold = threshold
+        self.k = k
+        self.channels = np.asarray(channels)
+
 
-    while True:
-        data = s.recv(segment_length*4 - bytes_received)
-        bytes_received = bytes_received + len(data)
-        segment_data.extend(data)
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Creates a KOfNRule from a spec such as 'peak_count:2:3:21,22,31',
+        i.e. the feature, its threshold, k and the electrodes, which
+        are given by their MCS grid position.
+        """
+        try:
+            feature, threshold, k, electrodes = spec.split(':')
+            channels = [chconv.MCSChannelConverter.mcsviz_to_channel[int(e)]
+                        for e in electrodes.split(',')]
+            return cls(feature, float(threshold), int(k), channels)
+        except (KeyError, ValueError) as e:
+            raise ValueError('Malformed rule {spec}'.format(spec=spec)) from e
 
-        if (bytes_received != segment_length*4):
-            continue
 
-        for i in struct.iter_unpack('f', segment_data):
-                channel_data.append(i[0])
+    def fires(self, features):
+        return np.count_nonzero(features[self.feature][self.channels] >= self.threshold) >= self.k
 
-        return channel_data
 
+    def __str__(self):
+        return '{k} of {n} channels with {f} >= {t}'.format(
+            k=self.k, n=len(self.channels), f=self.feature, t=self.threshold)
 
-def run_demo(connection, verbose=True):
+
+class FrameDetector(object):
+    """
+    Decides whether stimuli are seen in a frame of any amount of
+    channels, sampled at <sample_rate> Hz. The features of every
+    channel are computed at once over the whole frame:
+
+    - sma: the absolute mean amplitude,
+    - peak_count: how many times the signal rises above
+      <peak_threshold> volts,
+    - band_power: the mean power within the frequency <band> (Hz).
+
+    A frame is positive if any of the KOfNRules in <rules> fires. By
+    default, the detector makes the same decision as the original
+    single channel demo on row <channel> of the frame.
+    """
+    features = ['sma', 'peak_count', 'band_power']
+
+    def __init__(self, sample_rate=10000, peak_threshold=7.3e-5, band=(300, 3000), rules=None, channel=0):
+        self.sample_rate = sample_rate
+        self.peak_threshold = peak_threshold
+        self.band = band
+        if rules is None:
+            rules = [KOfNRule('sma', 1e-5, 1, [channel]), KOfNRule('peak_count', 1, 1, [channel])]
+        self.rules = rules
+        self.band_bins = None
+
+
+    def compute_features(self, frame):
+        """
+        Returns the features of all channels of <frame>, as a dict of
+        arrays with a value per channel.
+        """
+        samples = frame.shape[1]
+        above = frame >= self.peak_threshold
+        peak_count = np.count_nonzero(above[:, 1:] & ~above[:, :-1], axis=1) + above[:, 0]
+
+        # Only computed if a rule needs it, as it is the most costly.
+        band_power = None
+        if any(rule.feature == 'band_power' for rule in self.rules):
+            if self.band_bins is None or len(self.band_bins) != samples//2 + 1:
+                frequencies = np.fft.rfftfreq(samples, 1 / self.sample_rate)
+                self.band_bins = (frequencies >= self.band[0]) & (frequencies < self.band[1])
+            spectrum = np.fft.rfft(frame, axis=1)[:, self.band_bins]
+            band_power = 2 * np.sum(np.abs(spectrum)**2, axis=1) / samples**2
+
+        return {'sma': np.abs(frame.mean(axis=1)),
+                'peak_count': peak_count,
+                'band_power': band_power}
+
+
+    def decide(self, frame):
+        features = self.compute_features(frame)
+        return 1.0 if any(rule.fires(features) for rule in self.rules) else 0.0
+
+
+def connect_to_grinder(verbose=True, sensor=True, channels=1, segment_length=1000, detector=None):
+    host = '0.0.0.0'
+    port = 8080
+
+    try:
+        with SegmentReader(host, port, segment_length=segment_length, channels=channels) as reader:
+            return run_demo(reader, verbose, sensor, detector)
+    except Exception as e:
+        logger.info('Could not connect to remote grinder instance')
+        logger.error(traceback.format_exc())
+
+
+def run_demo(reader, verbose=True, sensor=True, detector=None):
+    """
+    Runs the closed loop on the segments read by the SegmentReader
+    <reader>, where every segment is classified by the FrameDetector
+    <detector> (the default one if None). Without a <sensor>, no
+    stimuli is applied, which is used to run the detection over
+    recordings that Grinder streams in bulk. Returns the predictions
+    made for every segment when the stream ends.
+
+    All statistics of the loop are kept in running windows, so the
+    cost of a decision does not depend on the window size. Commands to
+    MEAME are fired without waiting for its response, such that
+    receiving data is never stalled by them.
+
+    The loop is traced by the module tracer: the cost of every
+    decision, the time from the sensor reading that made an object
+    close until MEAME has responded to the request to stimulate, and
+    from the request until the first positive segment and the
+    prediction event.
+    """
     global stimuli_state
 
     meame = meamer.MEAMEr('10.20.92.130')
-    SMA_amplitude_threshold = 1e-5
-    peak_amplitude_threshold = 7.3e-5
+    sample_rate = 10000
+    if detector is None:
+        detector = FrameDetector(sample_rate)
     current_segment = 0
-    window_size = 10
-    previous_predictions = []
+    window_size = max(sample_rate // reader.segment_length, 1)
+    previous_predictions = streamstats.RunningWindow(window_size)
+    predictions = []
     previous_object_state = False
+    awaiting_segment = awaiting_event = False
     sensor_thread = sthread.StoppableThread(target=receive_sensor)
-    sensor_thread.start()
+
+    # Called on the command thread of MEAMEr once MEAME has responded.
+    def stimulation_started(future):
+        if future.cancelled() or future.exception() is not None or not future.result():
+            error = None if future.cancelled() else future.exception()
+            logger.error('Could not start remote MEAME stimuli{e}'.format(
+                e='' if error is None else ' ({})'.format(error)))
+            return
+        tracer.mark('stim_response')
+        tracer.span('Stimulation request', 'stim_request', 'stim_response')
+        tracer.span('Sensor to stimulation', 'object_state_changed', 'stim_response')
+
+    if sensor:
+        sensor_thread.start()
 
     try:
         while True:
             if sthread.check_terminate_thread():
-                sensor_thread.stop()
-                sensor_thread.join()
-                return
+                break
 
-            segment = receive_segment(segment_length=1000, connection=connection)
+            segment = reader.read()
+            if segment is None:
+                logger.info('Stream ended after {n} segments'.format(n=len(predictions)))
+                break
 
-            if current_segment == 0:
-                with warnings.catch_warnings():
-                    warnings.simplefilter('ignore', category=RuntimeWarning)
-                    if verbose:
-                        logger.info('A second has passed, {}, {}, {}'.
-                                    format(abs(np.mean(segment)),
-                                           np.max(segment),
-                                           np.mean(previous_predictions)))
+            if current_segment == 0 and verbose:
+                logger.info('A second has passed, {}, {}, {}'.
+                            format(abs(segment.mean()), segment.max(), previous_predictions.mean()))
 
             current_segment = (current_segment + 1) % window_size
 
-            if abs(np.mean(segment))>= SMA_amplitude_threshold or \
-               np.max(segment) >= peak_amplitude_threshold:
-                prediction = 1.0
-            else:
-                prediction = 0.0
+            tracer.mark('segment')
+            prediction = detector.decide(segment)
+            tracer.span('Decision', 'segment')
+            if prediction and awaiting_segment:
+                tracer.span('Stimulation to first positive segment', 'stim_request', 'segment')
+                awaiting_segment = False
 
             # We keep a window of size <window_size> of the previous
             # predictions both for whether the external sensor is
@@ -140,11 +357,14 @@ def run_demo(connection, verbose=True):
             # a few of the predictions in this current window are
             # positive, we determine that we should act.
             previous_predictions.append(prediction)
-            previous_predictions = previous_predictions[-window_size:]
+            predictions.append(prediction)
 
-            if (np.mean(previous_predictions) >= 0.5):
+            if previous_predictions.mean() >= 0.5:
                 if not stimuli_state:
                     prediction_event.set()
+                    if awaiting_event:
+                        tracer.span('Stimulation to prediction event', 'stim_request')
+                        awaiting_event = False
                 stimuli_state = True
             else:
                 if stimuli_state:
@@ -155,22 +375,63 @@ def run_demo(connection, verbose=True):
                 previous_object_state ^= True
 
                 if previous_object_state:
-                    meame.start_stim()
-                    meame.setup_stim()
+                    tracer.mark('stim_request')
+                    meame.start_stim(setup=True, wait=False).add_done_callback(stimulation_started)
+                    awaiting_segment = awaiting_event = True
                     if verbose:
-                        logger.info('Started remote MEAME stimuli')
+                        logger.info('Requested remote MEAME stimuli to start')
                 else:
-                    meame.stop_stim()
+                    meame.stop_stim(wait=False)
+                    awaiting_segment = awaiting_event = False
                     if verbose:
-                        logger.info('Stopped remote MEAME stimuli')
+                        logger.info('Requested remote MEAME stimuli to stop')
 
     except KeyboardInterrupt as e:
-        sensor_thread.stop()
+        pass
 
-
-def main():
-    connect_to_grinder()
+    if sensor:
+        sensor_thread.stop()
+        sensor_thread.join()
+    meame.close()
+    for line in tracer.summary():
+        logger.info(line)
+    return predictions
+
+
+def main(args):
+    channels, segment_length, detector = 1, 1000, None
+    if args.frames:
+        # Decide on the channel that Grinder serves when not reflecting,
+        # unless told otherwise by rules.
+        channels, segment_length = 60, 100
+        detector = FrameDetector(channel=chconv.MCSChannelConverter.mcsviz_to_channel[21])
+    if args.segment_length:
+        segment_length = args.segment_length
+    if args.rule:
+        detector = FrameDetector(rules=[KOfNRule.from_spec(spec) for spec in args.rule])
+        logger.info('Detecting with rules: {r}'.format(r='; '.join(str(r) for r in detector.rules)))
+
+    predictions = connect_to_grinder(sensor=not args.no_sensor, channels=channels,
+                                     segment_length=segment_length, detector=detector)
+    if args.trace_output:
+        tracer.dump(args.trace_output)
+        logger.info('Wrote latencies of the loop to {f}'.format(f=args.trace_output))
+    if predictions is not None and args.no_sensor:
+        logger.info('{n} of {total} segments were predicted positive'.
+                    format(n=int(sum(predictions)), total=len(predictions)))
 
 
 if __name__ == '__main__':
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description='Closed-loop demo using an ultrasound sensor to apply stimuli')
+
+    parser.add_argument('--no-sensor', help='Only run detection, e.g. over recordings from Grinder --bulk', action='store_true')
+    parser.add_argument('--frames', help='Detect from all 60 channels, requires Grinder --reflect', action='store_true')
+    parser.add_argument('--segment-length', help='Samples per channel in each segment (1000, or 100 with --frames)', type=int)
+    parser.add_argument('--trace-output', help='JSON or CSV file to write the latencies of the loop to')
+    parser.add_argument('--rule', help='Detection rule FEATURE:THRESHOLD:K:ELECTRODES, e.g. peak_count:2:3:21,22,31 (repeatable)', action='append')
+
+    args = parser.parse_args()
+    if args.rule and not args.frames:
+        parser.error('--rule requires --frames, as rules select among all 60 channels')
+    main(args)
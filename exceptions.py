@@ -7,3 +7,11 @@ class UnresponsiveMEAMEError(Exception):
     def __init__(self, message, errors):
         super().__init__(message)
         self.errors = errors
+
+
+class AcquisitionStoppedError(Exception):
+    pass
+
+
+class EndOfStreamError(Exception):
+    pass
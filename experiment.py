@@ -2,12 +2,46 @@ import log
 logger = log.get_logger(__name__)
 
 from McsPy import McsData
+from concurrent.futures import Future, ThreadPoolExecutor
 import McsPy
+import collections
 import logging
+import os
+import threading
 import matplotlib.pyplot as plt
 import numpy as np
 
 
+# Experiments shared by the whole process, keyed by the absolute path
+# of their HDF5-file.
+_experiments = {}
+_experiments_lock = threading.Lock()
+
+
+def open_experiment(h5_file):
+    """
+    Returns the Experiment for <h5_file>. Experiments are shared by
+    the whole process, such that every recording is only opened once
+    no matter how many streams are replaying it. Synthetic data is
+    opened by giving a spec such as 'synthetic' or
+    'synthetic:sample_rate=25000,stim_rate=1' instead of a file.
+    """
+    # Imported here, as synthetic builds upon this module.
+    import synthetic
+
+    if synthetic.is_spec(h5_file):
+        key = h5_file
+    else:
+        key = os.path.abspath(h5_file)
+    with _experiments_lock:
+        if key not in _experiments:
+            if synthetic.is_spec(h5_file):
+                _experiments[key] = synthetic.SyntheticExperiment.from_spec(h5_file)
+            else:
+                _experiments[key] = Experiment(h5_file)
+        return _experiments[key]
+
+
 class Experiment(object):
     """
     Wraps recordings from MEA with nice-to-have methods for things
@@ -34,6 +68,50 @@ class Experiment(object):
         self.seconds_per_step = 15
         self.current_data = [[]]*60
 
+        # Raw ADC values of all channels, as (channels, samples).
+        self.channel_data = self.map_channel_data()
+        self.samples = self.channel_data.shape[1]
+
+        # McsPy is only used for the metadata needed to scale raw ADC
+        # values, which is gathered once such that scaling can be
+        # done for all channels at once.
+        infos = [self.stream.channel_infos[ch] for ch in range(self.channels)]
+        self.channel_rows = np.array([info.row_index for info in infos])
+        self.ad_zero = np.array([info.info['ADZero'] for info in infos])
+        self.adc_step = np.array([info.adc_step.magnitude for info in infos])
+
+        self.init_block_cache()
+
+
+    def init_block_cache(self):
+        """
+        Sets up blocks of <seconds_per_step> seconds of scaled data
+        for all channels, shared by every user of the experiment. Only
+        the <cached_blocks> most recently used blocks are kept around.
+        """
+        self.block_length = int(self.seconds_per_step * self.sample_rate)
+        self.blocks = -(-self.samples // self.block_length)
+        self.cached_blocks = 3
+        self.block_cache = collections.OrderedDict()
+        self.block_cache_lock = threading.Lock()
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+
+
+    def map_channel_data(self):
+        """
+        Memory maps the ChannelData dataset of the HDF5-file, such
+        that it can be sliced without copying, and shared between
+        processes through the page cache. Chunked or compressed
+        datasets can not be mapped, in which case the h5py dataset is
+        returned as-is.
+        """
+        dataset = self.stream.channel_data
+        offset = dataset.id.get_offset()
+        if offset is None or dataset.chunks is not None or dataset.compression is not None:
+            return dataset
+        return np.memmap(self.filename, mode='r', dtype=dataset.dtype,
+                         shape=dataset.shape, offset=offset)
+
 
     def get_channel_data(self, channel):
         """
@@ -58,11 +136,89 @@ class Experiment(object):
         stop = int((self.current_second+self.seconds_per_step) * self.sample_rate)
         self.current_second += self.seconds_per_step
 
-        for ch in range(60):
-            self.current_data[ch] = self.get_channel_in_range(ch, start, stop)[0]
+        # McsPy includes the sample at the end index, as do we.
+        self.current_data = self.read_range(start, stop + 1)
         return self.current_data
 
 
+    def read_range(self, start, stop, channels=None):
+        """
+        Returns samples <start> to <stop> of the given <channels> (all
+        channels if None) as a (channels, samples) float32 array. The
+        rows spanning the channels are read in a single hyperslab
+        read, and the ADZero/ConversionFactor scaling of McsPy is
+        applied to all channels at once.
+        """
+        stop = min(stop, self.samples)
+        if channels is None:
+            channels = np.arange(self.channels)
+        channels = np.asarray(channels)
+
+        rows = self.channel_rows[channels]
+        first_row, last_row = rows.min(), rows.max()
+        raw = self.channel_data[first_row:last_row+1, start:stop]
+
+        data = np.empty((len(channels), raw.shape[1]), dtype=np.float32)
+        np.multiply(raw[rows - first_row] - self.ad_zero[channels, np.newaxis],
+                    self.adc_step[channels, np.newaxis], out=data)
+        return data
+
+
+    def read_block(self, index):
+        """
+        Reads block number <index> of all channels as a (channels,
+        block_length) float32 array.
+        """
+        start = index * self.block_length
+        return self.read_range(start, start + self.block_length)
+
+
+    def get_block(self, index):
+        """
+        Returns block number <index>, which is read from the
+        HDF5-file only if no one else has done so already. The
+        returned array is shared, and must not be written to. Blocks
+        are loaded outside of the cache lock, such that loading one
+        block never stalls users of another.
+        """
+        with self.block_cache_lock:
+            future = self.block_cache.get(index)
+            load = future is None
+            if load:
+                future = Future()
+                self.block_cache[index] = future
+                if len(self.block_cache) > self.cached_blocks:
+                    self.block_cache.popitem(last=False)
+            else:
+                self.block_cache.move_to_end(index)
+
+        if load:
+            try:
+                block = self.read_block(index)
+                block.flags.writeable = False
+                future.set_result(block)
+            except Exception as e:
+                with self.block_cache_lock:
+                    self.block_cache.pop(index, None)
+                future.set_exception(e)
+        return future.result()
+
+
+    def prefetch_block(self, index):
+        """
+        Starts reading block number <index> in the background, and
+        returns a future of the block. Streams hold on to this future
+        until they need the block, as other streams at other offsets
+        may evict it from the shared cache in the meantime.
+        """
+        with self.block_cache_lock:
+            future = self.block_cache.get(index)
+            if future is not None:
+                self.block_cache.move_to_end(index)
+                return future
+        return self.prefetcher.submit(self.get_block, index)
+
+
     def info(self):
         """
         Outputs information about the corresponding experiment.
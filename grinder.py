@@ -4,6 +4,7 @@ logger = log.get_logger(__name__)
 import channelconverter as chconv
 import experiment
 import meamer
+import asyncio
 import socket
 import threading
 import time
@@ -11,13 +12,18 @@ import requests
 import struct
 import json
 import traceback
+import functools
 import keyboard
 import sthread
-from exceptions import UnresponsiveMEAMEError
+import ring
+import pacer
+import numpy as np
+from exceptions import UnresponsiveMEAMEError, AcquisitionStoppedError, EndOfStreamError
 
 
 class Stream(object):
-    def __init__(self):
+    def __init__(self, channel=0):
+        self.channel = channel
         self.reflect = False
 
 
@@ -29,26 +35,84 @@ class Stream(object):
         self.reflect = False
 
 
+    def select(self, frame):
+        """
+        Returns the part of a frame that is sent to the client: the
+        whole frame when reflecting, otherwise only the segment of the
+        wanted channel.
+        """
+        if self.reflect:
+            return frame
+        return frame[self.channel]
+
+
+    def encode(self, frame):
+        """
+        Returns the bytes to be sent to a client for a frame.
+        """
+        return self.select(frame).tobytes()
+
+
+    def end_of_stream(self, frame_shape):
+        """
+        Returns the end of stream marker, which is a payload of the
+        same size as any other payload, with all values set to NaN.
+        """
+        return self.encode(np.full(frame_shape, np.nan, dtype=np.float32))
+
+
+    def send_frame(self, frame):
+        """
+        Sends a frame to the client with a single sendall. When
+        reflecting, all channels are gathered into one contiguous
+        float32 buffer (which is free if the frame already is
+        contiguous), instead of packing and sending each channel
+        separately.
+        """
+        data = np.ascontiguousarray(self.select(frame), dtype=np.float32)
+        self.client.sendall(memoryview(data))
+
+
 class PlaybackStream(Stream):
-    def __init__(self, client, channel, segment_length=100, active_experiment='default'):
+    """
+    Replays a recording to a client. The recording is looped forever,
+    unless the stream is in bulk mode: bulk streams are unpaced, and
+    send the recording once, as fast as the client can receive it,
+    followed by an end of stream marker.
+    """
+    def __init__(self, client, channel, segment_length=100, active_experiment='default',
+                 speed=1.0, bulk=False):
         super().__init__()
         self.client = client
-        self.tick_rate = 0.01
         self.channel = channel
         self.segment_length = segment_length
         self.available_ticks = 0
 
-        # Initialize the actual experiment
+        # Initialize the actual experiment, which is shared with all
+        # other streams replaying the same recording.
         if active_experiment == 'default':
             active_experiment = 'mea_data/1.h5'
-        self.experiment = experiment.Experiment(active_experiment)
+        self.experiment = experiment.open_experiment(active_experiment)
+
+        # A segment is sent every tick, such that the recording is
+        # replayed at its own sample rate.
+        self.tick_rate = self.segment_length / self.experiment.sample_rate
         self.data_per_tick = int(self.experiment.sample_rate * self.tick_rate)
+        self.block_index = -1
         self.change_channel(self.channel)
 
+        # Blocks are double-buffered: the next block is read in the
+        # background while the current one is being published. The
+        # future of the next block is kept by the stream itself, such
+        # that the block survives being evicted from the shared cache.
+        self.next_block = self.experiment.prefetch_block(0)
+        self.worst_tick_latency = 0
+        self.bulk = bulk
+        if self.bulk:
+            speed = 0
+        self.pacer = pacer.Pacer(self.tick_rate, speed=speed, samples_per_tick=segment_length)
+
 
-    # For now each PlaybackStream has a copy of the experiment that it
-    # will receive from Server, which may need to be re-done in the
-    # future.
     def change_channel(self, ch):
         self.channel = ch
 
@@ -61,43 +125,123 @@ class PlaybackStream(Stream):
 
 
     def get_tick_data(self):
-        self.data = self.experiment.get_tick_data()
-        self.available_ticks = len(self.data[0]) // self.segment_length
+        if self.block_index >= 0:
+            logger.info('Worst tick latency of block {i}: {ms:.2f} ms ({pace})'.
+                        format(i=self.block_index, ms=self.worst_tick_latency*1000,
+                               pace=self.pacer.summary()))
+            self.worst_tick_latency = 0
+
+        self.block_index = (self.block_index + 1) % self.experiment.blocks
+        self.data = self.next_block.result()
+        self.next_block = self.experiment.prefetch_block((self.block_index + 1) % self.experiment.blocks)
+        self.available_ticks = self.data.shape[1] // self.segment_length
         self.data_tick_length = self.available_ticks
 
 
     def tick(self):
-        self.available_ticks -= 1
-        time.sleep(self.tick_rate)
+        self.pacer.wait()
 
 
-    def publish(self):
+    def next_frame(self):
+        """
+        Returns the segments of all channels for the current tick as
+        a (60, segment_length) array, and moves on to the next
+        tick. Returns None when a bulk stream reaches the end of the
+        recording.
+        """
+        if self.finished():
+            return None
         if self.available_ticks == 0:
             self.get_tick_data()
 
         start = (self.data_tick_length - self.available_ticks) * self.segment_length
         stop = start + self.segment_length
-        for ch in range(60):
-            data = self.data[ch][start:stop]
-            if self.reflect:
-                self.client.send(struct.pack('{}f'.format(len(data)), *data))
-            elif ch == self.channel:
-                self.client.send(struct.pack('{}f'.format(len(data)), *data))
+        self.available_ticks -= 1
+        return self.data[:, start:stop]
+
+
+    def finished(self):
+        return self.bulk and self.available_ticks == 0 and \
+            self.block_index == self.experiment.blocks - 1
+
+
+    def record_tick_latency(self, latency):
+        self.worst_tick_latency = max(self.worst_tick_latency, latency)
+
+
+    def publish(self):
+        start = time.perf_counter()
+        frame = self.next_frame()
+        if frame is None:
+            self.client.sendall(self.end_of_stream((self.experiment.channels, self.segment_length)))
+            raise EndOfStreamError('Reached the end of {f}'.format(f=self.experiment.filename))
+
+        self.send_frame(frame)
+        self.record_tick_latency(time.perf_counter() - start)
 
 
     def close(self):
         self.client.close()
 
 
+class LiveAcquisition(object):
+    """
+    Acquires frames from a remote MEAME DAQ server in a single
+    thread, and publishes them into a FrameRing. Every LiveStream of a
+    Server reads from the same ring, such that MEAME is only connected
+    to once no matter how many clients are attached.
+    """
+    def __init__(self, meame_addr, sample_rate=10000, segment_length=1000, slots=32):
+        self.meame = meamer.MEAMEr(meame_addr)
+        self.meame.initialize_DAQ(sample_rate=sample_rate, segment_length=segment_length)
+        self.meame.enable_DAQ_listener()
+        self.ring = ring.FrameRing(slots, (self.meame.channels, segment_length))
+        self.thread = sthread.StoppableThread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        try:
+            while True:
+                if sthread.check_terminate_thread(): return
+                self.ring.write(self.meame.recv_frame())
+        except OSError as e:
+            if not self.thread.stopped():
+                logger.error('Lost connection to remote MEAME DAQ server')
+                logger.error('{e}'.format(e=e))
+        finally:
+            self.ring.close()
+            self.meame.disable_DAQ_listener()
+
+
+    def is_running(self):
+        return self.thread.is_alive()
+
+
+    def stop(self):
+        self.thread.stop()
+        try:
+            self.meame.DAQ_listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.thread.join()
+
+
 class LiveStream(Stream):
-    def __init__(self, client, channel, meame_addr):
+    """
+    A reader of the frames published by a LiveAcquisition. Clients
+    that are too slow to keep up are lapped by the acquisition, and
+    skip ahead to the newest frame instead of stalling it.
+    """
+    def __init__(self, client, channel, acquisition):
         super().__init__()
         self.client = client
         self.channel = channel
         self.reflect =  False
-        self.meame = meamer.MEAMEr(meame_addr)
-        self.meame.initialize_DAQ(sample_rate=10000, segment_length=1000)
-        self.meame.enable_DAQ_listener()
+        self.ring = acquisition.ring
+        self.frame = np.empty_like(self.ring.frames[0])
+        self.next_frame_seq = self.ring.written
+        self.dropped_frames = 0
 
 
     def change_channel(self, ch):
@@ -108,40 +252,86 @@ class LiveStream(Stream):
         return
 
 
-    def publish(self):
+    def next_frame(self):
         """
-        Receive a whole segment for all channels, and forwards the
-        segment for the wanted channel to the client.
+        Returns the next frame of the acquisition, or None if no frame
+        has arrived within a second.
         """
-        current_channel = 0
+        try:
+            seq = self.ring.read(self.next_frame_seq, self.frame, timeout=1)
+        except EOFError:
+            raise AcquisitionStoppedError('Live acquisition has stopped')
 
-        while True:
-            data = self.meame.recv_segment()
+        if seq is None:
+            return None
 
-            if self.reflect:
-                self.client.send(struct.pack('{}f'.format(len(data)), *data))
-            elif current_channel == self.channel:
-                self.client.send(struct.pack('{}f'.format(len(data)), *data))
+        if seq != self.next_frame_seq:
+            self.dropped_frames += seq - self.next_frame_seq
+            logger.info('Client is lagging behind, {n} frames dropped in total'.
+                        format(n=self.dropped_frames))
+        self.next_frame_seq = seq + 1
+        return self.frame
 
-            current_channel += 1
-            if current_channel == 60:
-                return
+
+    def publish(self):
+        """
+        Receive a whole frame (a segment for all channels), and
+        forwards the segment for the wanted channel to the client.
+        """
+        frame = self.next_frame()
+        if frame is None:
+            return
+        self.send_frame(frame)
 
 
     def close(self):
         self.client.close()
-        self.meame.disable_DAQ_listener()
 
 
 class Server(object):
     def __init__(self, port, auto_setup=False, sawtooth=False, reflect=False,
-                 meame_addr=''):
+                 meame_addr='', speed=1.0, bulk=False, active_experiment='default'):
         self.host = '0.0.0.0'
         self.port = port
         self.auto_setup = auto_setup
         self.sawtooth = sawtooth
         self.reflect = reflect
         self.meame_addr = meame_addr
+        self.speed = speed
+        self.bulk = bulk
+        self.active_experiment = active_experiment
+        self.acquisition = None
+        self.acquisition_lock = threading.Lock()
+        self.socket = None
+
+
+    def get_acquisition(self):
+        """
+        Returns the live acquisition shared by all clients, which is
+        started by the first client to connect.
+        """
+        with self.acquisition_lock:
+            if self.acquisition is None or not self.acquisition.is_running():
+                self.acquisition = LiveAcquisition(self.meame_addr)
+            return self.acquisition
+
+
+    def stop_acquisition(self):
+        with self.acquisition_lock:
+            if self.acquisition is not None:
+                self.acquisition.stop()
+                self.acquisition = None
+
+
+    def stop(self):
+        """
+        Stops the live acquisition and closes the listening socket, if
+        the server got as far as creating them.
+        """
+        self.stop_acquisition()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
 
 
     def listen(self):
@@ -160,11 +350,14 @@ class Server(object):
             while True:
                 (client, addr) = self.socket.accept()
                 client.settimeout(60)
-                if sthread.check_terminate_thread(): return
+                if sthread.check_terminate_thread():
+                    self.stop_acquisition()
+                    return
                 logger.info('Received connection from {addr}'.format(addr=addr))
                 threading.Thread(target=self.handle_client, args=(client, addr)).start()
         except (KeyboardInterrupt, SystemExit):
             logger.info('Shutdown request detected, shutting down gracefully')
+            self.stop_acquisition()
             self.socket.shutdown(socket.SHUT_RDWR)
 
 
@@ -175,20 +368,24 @@ class Server(object):
         """
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.connect((addr, port))
-            stream = PlaybackStream(s, ch)
+            stream = PlaybackStream(s, ch, active_experiment=self.active_experiment,
+                                    speed=self.speed, bulk=self.bulk)
             while True:
                 try:
                     stream.publish()
                     stream.tick()
+                except EndOfStreamError:
+                    logger.info('Finished streaming to {addr}, closing connection'.format(addr=addr))
+                    break
                 except (BrokenPipeError, OSError):
                     logger.info('Closing connection to {addr}'.format(addr=addr))
-                    client.close()
                     break
 
 
     def setup_playback_stream(self, client):
         if self.auto_setup:
-            return PlaybackStream(client, 0, segment_length=100, active_experiment='default')
+            return PlaybackStream(client, 0, segment_length=100, active_experiment=self.active_experiment,
+                                  speed=self.speed, bulk=self.bulk)
         else:
             try:
                 settings_json = client.recv(2048)
@@ -199,7 +396,8 @@ class Server(object):
 
             try:
                 return PlaybackStream(client, settings['channel'], segment_length=100,
-                                      active_experiment=settings['experiment'])
+                                      active_experiment=settings['experiment'],
+                                      speed=self.speed, bulk=self.bulk)
             except KeyError as e:
                 logger.info('Received malformed settings from {addr}, disconnecting'.format(addr=addr))
                 stream.close()
@@ -208,7 +406,7 @@ class Server(object):
 
     def setup_live_stream(self, client):
         channel = chconv.MCSChannelConverter.mcsviz_to_channel[21]
-        return LiveStream(client, channel, self.meame_addr)
+        return LiveStream(client, channel, self.get_acquisition())
 
 
     def handle_client(self, client, addr):
@@ -240,11 +438,19 @@ class Server(object):
                     else:
                         data = [0 for x in range(100)]
 
-                    client.send(struct.pack('{}f'.format(len(data)), *data))
+                    client.sendall(struct.pack('{}f'.format(len(data)), *data))
                     time.sleep(0.01)
                 else:
                     stream.publish()
                 stream.tick()
+            except AcquisitionStoppedError:
+                logger.info('Live acquisition stopped, closing connection from {addr}'.format(addr=addr))
+                client.close()
+                break
+            except EndOfStreamError:
+                logger.info('Finished streaming to {addr}, closing connection'.format(addr=addr))
+                client.close()
+                break
             except (BrokenPipeError, OSError):
                 logger.info('Closing connection from {addr} (broken pipe)'.format(addr=addr))
                 client.close()
@@ -257,17 +463,240 @@ class Server(object):
                 break
 
 
+class AsyncClient(object):
+    """
+    State of a single client of an AsyncServer. Payloads are put in a
+    bounded send queue, and the oldest queued payload is dropped if
+    the client is not able to keep up.
+    """
+    def __init__(self, stream, writer, addr, max_queue_depth):
+        self.stream = stream
+        self.writer = writer
+        self.addr = addr
+        self.queue = asyncio.Queue(maxsize=max_queue_depth)
+        self.dropped_payloads = 0
+        self.tasks = []
+
+
+    def enqueue(self, payload):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.dropped_payloads += 1
+        self.queue.put_nowait(payload)
+
+
+    async def send_loop(self):
+        while True:
+            payload = await self.queue.get()
+            self.writer.write(payload)
+            await self.writer.drain()
+            self.queue.task_done()
+
+
+class AsyncServer(Server):
+    """
+    Serves the same protocol as Server, but handles all clients in a
+    single asyncio event loop instead of a thread per client. Each
+    client has a send queue of at most <max_queue_depth> payloads,
+    which is emptied by a task that waits on writer.drain(), such that
+    a slow client only ever loses its own data. Live frames are read
+    from the shared acquisition once, and encoded once per channel,
+    no matter how many clients are connected.
+    """
+    def __init__(self, port, max_queue_depth=8, **kwargs):
+        super().__init__(port, **kwargs)
+        self.max_queue_depth = max_queue_depth
+        self.live_clients = set()
+        self.live_broadcaster = None
+
+
+    def listen(self):
+        try:
+            asyncio.run(self.serve())
+        except (KeyboardInterrupt, SystemExit):
+            logger.info('Shutdown request detected, shutting down gracefully')
+        finally:
+            self.stop_acquisition()
+
+
+    async def serve(self):
+        try:
+            server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+            logger.info('Asyncio server started on {host}:{port}'.format(host=self.host, port=self.port))
+        except OSError as e:
+            logger.error('Could not bind to port {port}'.format(port=self.port))
+            logger.error('{e}'.format(e=e))
+            return
+
+        async with server:
+            while not sthread.check_terminate_thread():
+                await asyncio.sleep(1)
+
+
+    async def setup_async_playback_stream(self, reader, addr):
+        if self.auto_setup:
+            channel, active_experiment = 0, self.active_experiment
+        else:
+            try:
+                settings_json = await reader.read(2048)
+                settings = json.loads(settings_json.decode('utf-8'))
+                channel, active_experiment = settings['channel'], settings['experiment']
+            except (json.decoder.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError):
+                logger.info('Received malformed settings from {addr}, disconnecting'.format(addr=addr))
+                return None
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(
+            PlaybackStream, None, channel, segment_length=100, active_experiment=active_experiment,
+            speed=self.speed, bulk=self.bulk))
+
+
+    async def playback_loop(self, client):
+        """
+        Produces the frames of a PlaybackStream, paced by its
+        Pacer. Loading of experiment data is done in an executor, to
+        not block the other clients. Unpaced streams wait for room in
+        the send queue instead of dropping payloads.
+        """
+        loop = asyncio.get_running_loop()
+        stream = client.stream
+
+        while True:
+            if stream.finished():
+                await client.queue.put(stream.end_of_stream((stream.experiment.channels,
+                                                             stream.segment_length)))
+                await client.queue.join()
+                logger.info('Finished streaming to {addr}, closing connection'.format(addr=client.addr))
+                return
+
+            start = loop.time()
+            if stream.available_ticks == 0:
+                await loop.run_in_executor(None, stream.get_tick_data)
+            payload = stream.encode(stream.next_frame())
+            stream.record_tick_latency(loop.time() - start)
+
+            if stream.pacer.speed:
+                client.enqueue(payload)
+            else:
+                await client.queue.put(payload)
+            await asyncio.sleep(stream.pacer.delay())
+
+
+    async def broadcast_live(self, acquisition):
+        """
+        Reads frames from the shared acquisition, and queues them for
+        every live client. Waiting on the ring is done in an executor,
+        which is a single thread regardless of the amount of clients.
+        """
+        loop = asyncio.get_running_loop()
+        frame = np.empty_like(acquisition.ring.frames[0])
+        seq = acquisition.ring.written
+
+        while self.live_clients:
+            try:
+                read_seq = await loop.run_in_executor(None, acquisition.ring.read, seq, frame, 1)
+            except EOFError:
+                logger.info('Live acquisition stopped, closing all live connections')
+                for client in list(self.live_clients):
+                    for task in client.tasks:
+                        task.cancel()
+                return
+
+            if read_seq is None:
+                continue
+            seq = read_seq + 1
+
+            payloads = {}
+            for client in list(self.live_clients):
+                key = None if client.stream.reflect else client.stream.channel
+                if key not in payloads:
+                    payloads[key] = client.stream.encode(frame)
+                client.enqueue(payloads[key])
+
+
+    async def setup_async_live_stream(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.get_acquisition)
+        return Stream(channel=chconv.MCSChannelConverter.mcsviz_to_channel[21])
+
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        logger.info('Received connection from {addr}'.format(addr=addr))
+
+        if self.meame_addr:
+            try:
+                stream = await self.setup_async_live_stream()
+            except UnresponsiveMEAMEError:
+                logger.info('Remote MEAME was unresponsive: a MEAME server must be running')
+                writer.close()
+                return
+        else:
+            stream = await self.setup_async_playback_stream(reader, addr)
+            if stream is None:
+                writer.close()
+                return
+
+        if self.reflect:
+            stream.enable_reflector_mode()
+
+        client = AsyncClient(stream, writer, addr, self.max_queue_depth)
+        client.tasks.append(asyncio.ensure_future(client.send_loop()))
+        if self.meame_addr:
+            self.live_clients.add(client)
+            if self.live_broadcaster is None or self.live_broadcaster.done():
+                self.live_broadcaster = asyncio.ensure_future(self.broadcast_live(self.acquisition))
+        else:
+            client.tasks.append(asyncio.ensure_future(self.playback_loop(client)))
+
+        done, pending = await asyncio.wait(client.tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        self.live_clients.discard(client)
+
+        for task in done:
+            if task.cancelled():
+                continue
+            e = task.exception()
+            if isinstance(e, (BrokenPipeError, ConnectionResetError)):
+                logger.info('Closing connection from {addr} (broken pipe)'.format(addr=addr))
+            elif e is not None:
+                logger.error('Error handling connection from {addr}'.format(addr=addr))
+                logger.error(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+        if client.dropped_payloads:
+            logger.info('{n} payloads were dropped for {addr}'.format(n=client.dropped_payloads, addr=addr))
+        writer.close()
+
+
 def main(args):
+    server = None
     try:
-        server = Server(8080,
-                        auto_setup=args.auto_setup,
-                        sawtooth=args.sawtooth,
-                        reflect=args.reflect,
-                        meame_addr=args.live)
+        if args.asyncio:
+            server = AsyncServer(8080,
+                                 max_queue_depth=args.max_queue_depth,
+                                 auto_setup=args.auto_setup,
+                                 reflect=args.reflect,
+                                 meame_addr=args.live,
+                                 speed=args.speed,
+                                 bulk=args.bulk,
+                                 active_experiment=args.experiment)
+        else:
+            server = Server(8080,
+                            auto_setup=args.auto_setup,
+                            sawtooth=args.sawtooth,
+                            reflect=args.reflect,
+                            meame_addr=args.live,
+                            speed=args.speed,
+                            bulk=args.bulk,
+                            active_experiment=args.experiment)
         server.listen()
     except Exception as e:
         logger.info('Unexpected event, shutting down gracefully')
-        server.socket.shutdown(socket.SHUT_RDWR)
+        logger.error(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+        if server is not None:
+            server.stop()
 
 
 if __name__ == '__main__':
@@ -280,5 +709,15 @@ if __name__ == '__main__':
     parser.add_argument('--sawtooth', help='Set server to auto generate sawtooth waves', action='store_true')
     parser.add_argument('--reflect', help='Reflect the stream data «as-is», without demultiplexing channels', action='store_true')
 
+    parser.add_argument('--experiment', help='Recording served with --auto-setup, or synthetic data such as "synthetic:stim_rate=1"', default='default')
+    parser.add_argument('--speed', help='Playback speed relative to real time (see --bulk to play as fast as possible)', type=float, default=1.0)
+    parser.add_argument('--bulk', help='Stream recordings once as fast as possible, ending with an end of stream marker', action='store_true')
+    parser.add_argument('--asyncio', help='Serve all clients from a single asyncio event loop', action='store_true')
+    parser.add_argument('--max-queue-depth', help='Payloads queued per client before dropping (asyncio only)', type=int, default=8)
+
     args = parser.parse_args()
+    if args.asyncio and args.sawtooth:
+        parser.error('--sawtooth is not supported together with --asyncio')
+    if not args.speed > 0:
+        parser.error('--speed must be a positive number, use --bulk to play as fast as possible')
     main(args)
@@ -412,16 +412,15 @@ class MainWindow(QWidget):
 
 
     def setup_stimuli(self):
-        self.meamer.setup_stim()
+        self.meamer.setup_stim(wait=False)
 
 
     def start_stimuli(self):
-        self.meamer.start_stim()
-        self.meamer.setup_stim()
+        self.meamer.start_stim(setup=True, wait=False)
 
 
     def stop_stimuli(self):
-        self.meamer.stop_stim()
+        self.meamer.stop_stim(wait=False)
 
 
     def select_experiment(self):
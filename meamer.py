@@ -4,19 +4,45 @@ logger = log.get_logger(__name__)
 import socket
 import struct
 import requests
+import numpy as np
 import time
 import experiment
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from exceptions import UnresponsiveMEAMEError
 
 
 class MEAMEr(object):
-    def __init__(self, address):
+    """
+    Client of a remote MEAME server at <address>. HTTP requests go
+    through a single session, which keeps its connection to MEAME
+    alive between requests. Every request times out after
+    <http_timeout> seconds, and failing to connect is retried a couple
+    of times. Commands can also be fired without waiting for MEAME to
+    respond, in which case they are sent in order from a background
+    thread and tracked with futures.
+    """
+    def __init__(self, address, http_timeout=2.0):
         self.data_format = '<i'
+        self.channels = 60
         self.address = address
         self.mea_daq_port = 12340
         self.sawtooth_port = 12341
         self.http_address = 'http://' + self.address
         self.http_port = 8888
+        self.segment_buffer = None
+        self.frame_buffer = None
+
+        # Only failing to connect is retried, as MEAME may already
+        # have acted on a request that failed later on.
+        self.http_timeout = http_timeout
+        self.session = requests.Session()
+        retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.05)
+        self.session.mount('http://', HTTPAdapter(max_retries=retries))
+        self.command_executor = None
+        self.pending_commands = []
 
 
     def url(self, resource):
@@ -29,27 +55,76 @@ class MEAMEr(object):
 
 
     def simple_GET_request(self, url):
+        """
+        Sends a GET request to <url> of MEAME, and returns whether it
+        succeeded.
+        """
         try:
-            r = requests.get(self.url(url))
+            r = self.session.get(self.url(url), timeout=self.http_timeout)
             if r.status_code == 200:
                 logger.info('Successful GET request to {url}'.format(url=url))
+                return True
             else:
                 logger.error('Error, GET request to {url} (check MEAME logs)'.format(url=url))
-                return
+                return False
         except Exception as e:
             self.connection_error(e)
+            return False
+
+
+    def command(self, *urls, wait=True):
+        """
+        Sends GET requests to <urls> of MEAME in order, stopping at the
+        first that fails, and returns whether all of them succeeded.
+        If not <wait>, the requests are sent from a background thread
+        instead, and a future of the result is returned right away.
+        Commands that are not waited for are still sent in the order
+        they were given.
+        """
+        if wait:
+            return all(self.simple_GET_request(url) for url in urls)
+
+        if self.command_executor is None:
+            self.command_executor = ThreadPoolExecutor(max_workers=1)
+        future = self.command_executor.submit(self.command, *urls)
+        self.pending_commands = [f for f in self.pending_commands if not f.done()] + [future]
+        return future
 
 
-    def setup_stim(self):
-        self.simple_GET_request('/DSP/stim/setup')
+    def close(self, timeout=None):
+        """
+        Waits for pending commands to be sent, for at most <timeout>
+        seconds if given, and closes the connections to MEAME.
+        Commands that have not been sent by then are dropped.
+        """
+        if self.command_executor is not None:
+            _, unsent = concurrent.futures.wait(self.pending_commands, timeout=timeout)
+            dropped = [future for future in unsent if future.cancel()]
+            if dropped:
+                logger.error('Dropped {n} command(s) to MEAME that were not sent in time'.
+                             format(n=len(dropped)))
+            self.command_executor.shutdown(wait=not unsent)
+            self.command_executor = None
+        self.pending_commands = []
+        self.session.close()
+
 
+    def setup_stim(self, wait=True):
+        return self.command('/DSP/stim/setup', wait=wait)
 
-    def start_stim(self):
-        self.simple_GET_request('/DSP/stim/start')
 
+    def start_stim(self, setup=False, wait=True):
+        """
+        Starts the stimuli. With <setup>, the DSP is set up for them
+        right after, as part of the same command.
+        """
+        if setup:
+            return self.command('/DSP/stim/start', '/DSP/stim/setup', wait=wait)
+        return self.command('/DSP/stim/start', wait=wait)
 
-    def stop_stim(self):
-        self.simple_GET_request('/DSP/stim/stop')
+
+    def stop_stim(self, wait=True):
+        return self.command('/DSP/stim/stop', wait=wait)
 
 
     def flash_dsp(self):
@@ -60,6 +135,34 @@ class MEAMEr(object):
         self.simple_GET_request('/DSP/stim/debug')
 
 
+    def wait_for_DAQ(self, timeout=5.0, interval=0.05):
+        """
+        Polls /DAQ/status until MEAME reports the DAQ as running, and
+        returns whether it did within <timeout> seconds. A status that
+        does not say whether the DAQ is running is taken as running,
+        as there is then nothing to wait for.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                r = self.session.get(self.url('/DAQ/status'), timeout=self.http_timeout)
+                if r.status_code == 200:
+                    status = r.json()
+                    if not isinstance(status, dict) or 'isRunning' not in status:
+                        logger.info('Unknown DAQ status from MEAME, assuming it is running')
+                        return True
+                    if status['isRunning']:
+                        return True
+            except ValueError:
+                logger.info('Unknown DAQ status from MEAME, assuming it is running')
+                return True
+            except requests.RequestException as e:
+                logger.info('Could not get the DAQ status ({e})'.format(e=e))
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+
+
     def initialize_DAQ(self, sample_rate, segment_length):
         if self.address == 'localhost':
             self.sample_rate = sample_rate
@@ -67,10 +170,10 @@ class MEAMEr(object):
             return
 
         try:
-            r = requests.post(self.url('/DAQ/connect'), json = {
+            r = self.session.post(self.url('/DAQ/connect'), json = {
                 'samplerate': sample_rate,
                 'segmentLength': segment_length,
-            })
+            }, timeout=self.http_timeout)
 
             if r.status_code == 200:
                 logger.info('Successfully set up MEAME DAQ server')
@@ -78,7 +181,7 @@ class MEAMEr(object):
                 logger.info('DAQ connection failed (malformed request?)')
                 return
 
-            r = requests.get(self.url('/DAQ/start'))
+            r = self.session.get(self.url('/DAQ/start'), timeout=self.http_timeout)
             if r.status_code == 200:
                 logger.info('Successfully started DAQ server')
             else:
@@ -89,10 +192,9 @@ class MEAMEr(object):
             self.sample_rate = sample_rate
             self.segment_length = segment_length
 
-            # Sleep here to let the DAQ finish setting up. (TODO):
-            # This should actually be done by just fetching
-            # /DAQ/status.
-            time.sleep(0.5)
+            # Let the DAQ finish setting up before connecting to it.
+            if not self.wait_for_DAQ():
+                logger.error('Remote DAQ server did not report running after starting it')
         except Exception as e:
             self.connection_error(e)
 
@@ -106,7 +208,7 @@ class MEAMEr(object):
             return
 
         try:
-            r = requests.get(self.url('/DAQ/stop'))
+            r = self.session.get(self.url('/DAQ/stop'), timeout=self.http_timeout)
             if r.status_code == 200:
                 logger.info('Successfully stopped DAQ server')
             else:
@@ -152,12 +254,61 @@ class MEAMEr(object):
         return segment_data
 
 
-    def recv(self):
-        current_channel = 0
-        while True:
-            data = self.recv_segment()
+    def recv_exactly(self, buf):
+        """
+        Fills all of <buf> with data from the DAQ listener. recv_into
+        is used so that data is written straight into the given
+        buffer, instead of growing intermediate byte strings.
+        """
+        view = memoryview(buf)
+        while view:
+            bytes_received = self.DAQ_listener.recv_into(view)
+            if bytes_received == 0:
+                raise ConnectionResetError('Remote MEAME closed the DAQ connection')
+            view = view[bytes_received:]
+
+
+    def recv_segment_array(self):
+        """
+        Vectorized alternative to recv_segment. The segment is read
+        into a preallocated buffer and decoded with a single NumPy
+        scale, instead of unpacking each sample in Python. Note that
+        the returned float32 array is reused, and will be overwritten
+        by the next call.
+        """
+        if self.segment_buffer is None or \
+           len(self.segment_buffer) != self.segment_length*4:
+            self.segment_buffer = bytearray(self.segment_length*4)
+            self.segment_samples = np.frombuffer(self.segment_buffer, dtype=self.data_format)
+            self.segment_array = np.empty(self.segment_length, dtype=np.float32)
+
+        self.recv_exactly(self.segment_buffer)
+        np.multiply(self.segment_samples, experiment.Experiment.conversion_constant,
+                    out=self.segment_array)
+        return self.segment_array
+
 
-            if current_channel == 0:
-                print(len(data))
+    def recv_frame(self):
+        """
+        Receives a whole frame, i.e. a segment for every channel of
+        the interleaved stream, in a single bulk read. Returns a
+        (channels, segment_length) float32 array, that is reused and
+        overwritten by the next call.
+        """
+        frame_size = self.channels*self.segment_length*4
+        if self.frame_buffer is None or len(self.frame_buffer) != frame_size:
+            self.frame_buffer = bytearray(frame_size)
+            self.frame_samples = np.frombuffer(self.frame_buffer, dtype=self.data_format) \
+                                   .reshape(self.channels, self.segment_length)
+            self.frame_array = np.empty((self.channels, self.segment_length), dtype=np.float32)
 
-            current_channel = (current_channel + 1) % 60
+        self.recv_exactly(self.frame_buffer)
+        np.multiply(self.frame_samples, experiment.Experiment.conversion_constant,
+                    out=self.frame_array)
+        return self.frame_array
+
+
+    def recv(self):
+        while True:
+            frame = self.recv_frame()
+            print(frame.shape[1])
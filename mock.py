@@ -2,86 +2,317 @@ import log
 logger = log.get_logger(__name__)
 
 import experiment
+import http.server
+import json
 import socket
-import struct
 import time
+import numpy as np
 import threading
 import sthread
+import pacer
+import ring
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MEAMEHTTPHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Emulates the HTTP control endpoints of MEAME that MEAMEr uses, by
+    delegating requests to the MEAMEMock of the server. Connections
+    are kept alive between requests, like MEAMEr expects.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(*self.server.mock.handle_request('GET', self.path, None))
+
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+            self.respond(400, None)
+            return
+        self.respond(*self.server.mock.handle_request('POST', self.path, body))
+
+
+    def respond(self, status, body):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def log_message(self, format, *args):
+        logger.info('HTTP {addr} {msg}'.format(addr=self.address_string(), msg=format % args))
 
 
 class MEAMEMock(object):
-    def __init__(self, port):
+    """
+    Mocks a MEAME server by looping over <seconds> seconds of a
+    recording (all of it if None), starting at second <start>. The
+    recording is read lazily with read-ahead while replaying, such
+    that the mock is ready to serve as soon as it is started. The DAQ
+    stream is produced once into a ring buffer, and served to any
+    amount of simultaneous clients, while the HTTP control endpoints of
+    MEAME are emulated on <http_port>.
+    """
+    def __init__(self, port, recording='mea_data/1.h5', start=0, seconds=None,
+                 speed=1.0, segment_length=1000, http_port=8888):
         self.host = '0.0.0.0'
         self.port = port
-        self.experiment = experiment.Experiment('mea_data/1.h5')
-        self.tick_rate = 0.01
-        self.ticks_per_sec = int(1 / self.tick_rate)
-        self.data_per_tick = int(self.experiment.sample_rate * self.tick_rate)
-        self.data = {}
+        self.http_port = http_port
+        self.recording = recording
+        self.start = start
+        self.seconds = seconds
+        self.speed = speed
+        self.segment_length = segment_length
+        self.experiment = experiment.open_experiment(recording)
+        self.sample_rate = self.experiment.sample_rate
+        self.first_sample = min(int(start * self.sample_rate), self.experiment.samples)
+        self.last_sample = self.experiment.samples
+        if seconds is not None:
+            self.last_sample = min(self.first_sample + int(seconds * self.sample_rate),
+                                   self.last_sample)
+        self.read_ahead_seconds = 1
+
+        self.producer = None
+        self.producer_lock = threading.Lock()
+        self.http_server = None
+        self.stim_running = False
 
 
     def run(self):
-        # Only fetch a small amount of data that will be replayed. We
-        # are mostly just interested in having something that mocks
-        # MEAME at all for testing purposes.
-        logger.info('Initializing MEAME mock by reading experiment data')
-        self.seconds = 15
-        self.playback_length = int(self.seconds * self.experiment.sample_rate)
-        for i in range(60):
-            if sthread.check_terminate_thread(): return
-            logger.info('Channel {i} read'.format(i=i))
-            self.data[i] = self.experiment.get_channel_in_range(i, 0, self.playback_length)[0]
-
-        while True:
-            try:
-                if sthread.check_terminate_thread(): return
-                self.listen()
-            except KeyboardInterrupt:
+        self.start_http_server()
+        self.start_DAQ()
+        try:
+            self.listen()
+        except (KeyboardInterrupt, SystemExit):
+            logger.info('Shutdown request detected, shutting down gracefully')
+        finally:
+            self.stop_DAQ()
+            if self.http_server:
+                self.http_server.shutdown()
+                self.http_server.server_close()
+
+
+    def read_segments(self, position, segment_length):
+        """
+        Reads up to <read_ahead_seconds> seconds of whole segments of
+        <segment_length> samples from sample <position>, and converts
+        them to what MEAME sends over
+        the wire: int32 ADC counts, laid out as (segments, channels,
+        segment_length) such that every segment is one contiguous
+        buffer. Returns the segments and the position to continue
+        reading from, which wraps around at the end of the replayed
+        window.
+        """
+        read_ahead = max(int(self.read_ahead_seconds * self.sample_rate) // segment_length, 1)
+        segments = min(read_ahead, (self.last_sample - position) // segment_length)
+        stop = position + segments * segment_length
+
+        data = self.experiment.read_range(position, stop)
+        counts = (data / experiment.Experiment.conversion_constant).astype('<i4')
+        wire_data = np.ascontiguousarray(
+            counts.reshape(-1, segments, segment_length).transpose(1, 0, 2))
+
+        if stop + segment_length > self.last_sample:
+            stop = self.first_sample
+        return wire_data, stop
+
+
+    def start_DAQ(self):
+        """
+        Starts producing the DAQ stream with the current settings. A
+        running DAQ stream is only restarted if the settings have
+        changed, in which case its clients are disconnected. The
+        producer is given the segment length it was started with, and
+        never looks at later changes to the settings.
+        """
+        with self.producer_lock:
+            segment_length = self.segment_length
+            if self.DAQ_running() and self.ring.frames.shape[2] == segment_length:
                 return
+            if self.last_sample - self.first_sample < segment_length:
+                logger.error('The replayed window is shorter than a segment, not starting the DAQ')
+                return
+
+            self._stop_DAQ()
+            self.ring = ring.FrameRing(32, (self.experiment.channels, segment_length), dtype='<i4')
+            self.producer = sthread.StoppableThread(target=self.produce, args=(self.ring, segment_length),
+                                                   daemon=True)
+            self.producer.start()
+
+
+    def stop_DAQ(self):
+        with self.producer_lock:
+            self._stop_DAQ()
+
+
+    def _stop_DAQ(self):
+        if self.producer is not None:
+            self.producer.stop()
+            self.producer.join()
+            self.producer = None
+
+
+    def DAQ_running(self):
+        return self.producer is not None and self.producer.is_alive()
+
+
+    def produce(self, frame_ring, segment_length):
+        """
+        Writes the DAQ stream into <frame_ring> as segments of
+        <segment_length> samples, at the pace of the recording. The
+        next segments are read in the background while the current
+        ones are being replayed.
+        """
+        started = time.monotonic()
+        reader = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            wire_data, position = self.read_segments(self.first_sample, segment_length)
+            logger.info('First DAQ segments ready {t:.3f} s after starting the DAQ'.
+                        format(t=time.monotonic() - started))
+
+            segment_duration = segment_length / self.sample_rate
+            pace = pacer.Pacer(segment_duration, speed=self.speed, samples_per_tick=segment_length)
+            while True:
+                read_ahead = reader.submit(self.read_segments, position, segment_length)
+                for segment in wire_data:
+                    if sthread.check_terminate_thread(): return
+                    frame_ring.write(segment)
+                    pace.wait()
+
+                if position == self.first_sample:
+                    logger.info('Replayed all mock data ({pace})'.format(pace=pace.summary()))
+                wire_data, position = read_ahead.result()
+        finally:
+            frame_ring.close()
+            reader.shutdown(wait=False)
 
 
     def listen(self):
         logger.info('Setting up MEAME mock socket, awaiting connections')
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((self.host, self.port))
         s.listen(5)
 
-        client, addr = s.accept()
-        logger.info('Received connection from {addr}'.format(addr=addr))
-        tick = 0
-        prev_time = time.perf_counter()
         try:
             while True:
-                if sthread.check_terminate_thread(): return
-                for i in range(60):
-                    data = [int(x / experiment.Experiment.conversion_constant) for x in
-                            self.data[i][tick*self.data_per_tick:(tick+1)*self.data_per_tick]]
-                    client.send(struct.pack('<{}i'.format(len(data)), *data))
-                tick = (tick + 1) % (self.seconds * self.ticks_per_sec)
-
-                # To keep a steady pace, we need to sleep only a given
-                # amount of time, as it is unlikely that each
-                # iteration takes exactly the same amount of time.
-                diff = time.perf_counter() - prev_time
-                sleep_time = min(max(self.tick_rate - diff, 0), self.tick_rate)
-                prev_time = time.perf_counter()
-                time.sleep(sleep_time)
-        except (KeyboardInterrupt, SystemExit):
-            client.close()
-            logger.info('Shutdown request detected, shutting down gracefully')
+                client, addr = s.accept()
+                if sthread.check_terminate_thread():
+                    client.close()
+                    return
+                logger.info('Received connection from {addr}'.format(addr=addr))
+                threading.Thread(target=self.serve_client, args=(client, addr), daemon=True).start()
+        finally:
             s.close()
-        except (ConnectionAbortedError, ConnectionResetError,
-                BrokenPipeError):
+
+
+    def serve_client(self, client, addr):
+        """
+        Forwards the DAQ stream to a single client. Clients that can
+        not keep up skip ahead instead of slowing down the others.
+        """
+        frame_ring = self.ring
+        segment = np.empty_like(frame_ring.frames[0])
+        seq = frame_ring.written
+
+        try:
+            while True:
+                read_seq = frame_ring.read(seq, segment, timeout=1)
+                if read_seq is None:
+                    continue
+                seq = read_seq + 1
+                client.sendall(memoryview(segment))
+        except EOFError:
+            logger.info('DAQ stopped, disconnecting {addr}'.format(addr=addr))
+        except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError):
+            logger.info('Client {addr} disconnected'.format(addr=addr))
+        finally:
             client.close()
-            logger.info('Client disconnected, restarting mock')
-            s.close()
-            self.listen()
 
 
-def main():
-    mock = MEAMEMock(12340)
+    def start_http_server(self):
+        try:
+            self.http_server = http.server.ThreadingHTTPServer((self.host, self.http_port),
+                                                               MEAMEHTTPHandler)
+        except OSError as e:
+            logger.error('Could not bind HTTP server to port {port}, running without it'.
+                         format(port=self.http_port))
+            logger.error('{e}'.format(e=e))
+            return
+
+        self.http_server.daemon_threads = True
+        self.http_server.mock = self
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+        logger.info('Emulating MEAME HTTP endpoints on port {port}'.format(port=self.http_port))
+
+
+    def handle_request(self, method, path, body):
+        """
+        Handles a request to an emulated MEAME endpoint. Returns a
+        tuple of the HTTP status code and a JSON-serializable body.
+        """
+        if method == 'POST' and path == '/DAQ/connect':
+            try:
+                sample_rate, segment_length = body['samplerate'], int(body['segmentLength'])
+            except (KeyError, TypeError, ValueError):
+                return 400, None
+            if sample_rate != self.sample_rate:
+                logger.info('Requested sample rate {r} differs from the recording ({s}), ignoring'.
+                            format(r=sample_rate, s=self.sample_rate))
+            # Applied by the next start of the DAQ.
+            with self.producer_lock:
+                self.segment_length = segment_length
+            return 200, None
+
+        if method != 'GET':
+            return 404, None
+
+        if path == '/DAQ/start':
+            self.start_DAQ()
+        elif path == '/DAQ/stop':
+            self.stop_DAQ()
+        elif path == '/DAQ/status':
+            return 200, {'isRunning': self.DAQ_running()}
+        elif path == '/DSP/stim/start':
+            self.stim_running = True
+        elif path == '/DSP/stim/stop':
+            self.stim_running = False
+        elif path not in ['/DSP/stim/setup', '/DSP/stim/debug', '/DSP/flash']:
+            return 404, None
+        return 200, None
+
+
+def main(args):
+    mock = MEAMEMock(args.port,
+                     recording=args.recording,
+                     start=args.start,
+                     seconds=args.seconds,
+                     speed=args.speed,
+                     segment_length=args.segment_length,
+                     http_port=args.http_port)
     mock.run()
 
 
 if __name__ == '__main__':
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description='MEAME mock - replays a recording as a MEAME DAQ server')
+
+    parser.add_argument('--recording', help='HDF5-file to replay', default='mea_data/1.h5')
+    parser.add_argument('--start', help='Second of the recording to start replaying from', type=float, default=0)
+    parser.add_argument('--seconds', help='Seconds of the recording to replay (defaults to all of it)', type=float)
+    parser.add_argument('--speed', help='Replay speed relative to real time, 0 replays as fast as possible', type=float, default=1.0)
+    parser.add_argument('--segment-length', help='Samples per channel in each DAQ segment', type=int, default=1000)
+    parser.add_argument('--port', help='Port of the DAQ stream', type=int, default=12340)
+    parser.add_argument('--http-port', help='Port of the emulated HTTP endpoints', type=int, default=8888)
+
+    args = parser.parse_args()
+    if not args.speed >= 0:
+        parser.error('--speed must be a non-negative number')
+    main(args)
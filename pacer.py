@@ -0,0 +1,83 @@
+import time
+
+
+class Pacer(object):
+    """
+    Paces a loop to run once every <interval> seconds. Deadlines are
+    absolute points on the monotonic clock, so the time spent within
+    the loop itself never adds up to drift, and the loop catches up
+    after a stall by not sleeping until it is back on schedule. If it
+    has fallen more than <max_lag> seconds behind, the schedule is
+    restarted from the current time instead.
+
+    <speed> is a multiplier of the real time rate (e.g. 0.5, 1 or 10),
+    while a speed of 0 runs the loop as fast as possible.
+    <samples_per_tick> is only used to report the achieved sample
+    rate.
+    """
+    def __init__(self, interval, speed=1.0, samples_per_tick=1, max_lag=1.0):
+        # Also rejects NaN, which compares false to everything.
+        if not speed >= 0:
+            raise ValueError('Speed must be a non-negative number, not {s}'.format(s=speed))
+        self.interval = interval
+        self.speed = speed
+        self.samples_per_tick = samples_per_tick
+        self.max_lag = max_lag
+        self.reset()
+
+
+    def reset(self):
+        self.start = time.monotonic()
+        self.deadline = self.start
+        self.previous_tick = self.start
+        self.ticks = 0
+        self.jitter_squared_sum = 0.0
+        self.max_jitter = 0.0
+
+
+    def period(self):
+        return self.interval / self.speed if self.speed else 0
+
+
+    def delay(self):
+        """
+        Registers a tick, and returns the time in seconds to wait
+        until the deadline of the next tick. Usable from asyncio code,
+        where the wait is done with asyncio.sleep.
+        """
+        now = time.monotonic()
+        period = self.period()
+
+        # Jitter is the deviation of the time between two ticks from
+        # the period we are aiming for.
+        jitter = abs((now - self.previous_tick) - period)
+        self.jitter_squared_sum += jitter**2
+        self.max_jitter = max(self.max_jitter, jitter)
+        self.previous_tick = now
+        self.ticks += 1
+
+        self.deadline += period
+        if now - self.deadline > self.max_lag:
+            self.deadline = now
+        return max(self.deadline - now, 0)
+
+
+    def wait(self):
+        time.sleep(self.delay())
+
+
+    def sample_rate(self):
+        elapsed = time.monotonic() - self.start
+        return self.ticks * self.samples_per_tick / elapsed if elapsed else 0
+
+
+    def jitter(self):
+        """
+        Returns the RMS jitter of the ticks so far in seconds.
+        """
+        return (self.jitter_squared_sum / self.ticks)**0.5 if self.ticks else 0
+
+
+    def summary(self):
+        return '{rate:.0f} samples/s, {rms:.2f} ms RMS jitter, {max:.2f} ms max jitter'. \
+            format(rate=self.sample_rate(), rms=self.jitter()*1000, max=self.max_jitter*1000)
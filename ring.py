@@ -0,0 +1,116 @@
+import threading
+import numpy as np
+
+
+class FrameRing(object):
+    """
+    A fixed amount of preallocated frame slots, written to by a single
+    producer and read by any amount of readers. Each reader keeps
+    track of its own position as a sequence number. The producer never
+    waits for readers: a reader that falls more than a full ring
+    behind skips ahead to the newest frame, dropping what it missed.
+    """
+    def __init__(self, slots, shape, dtype=np.float32):
+        self.slots = slots
+        self.frames = np.zeros((slots,) + tuple(shape), dtype=dtype)
+        self.written = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+
+    def write(self, frame):
+        with self.cond:
+            np.copyto(self.frames[self.written % self.slots], frame)
+            self.written += 1
+            self.cond.notify_all()
+
+
+    def close(self):
+        """
+        Wakes up all readers, and signals that no more frames will be
+        written.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+    def read(self, seq, out, timeout=None):
+        """
+        Copies frame number <seq> into <out>. Returns the sequence
+        number of the frame that was actually copied, which is larger
+        than <seq> if the reader was lapped by the producer. Returns
+        None if no frame arrived within <timeout> seconds, and raises
+        EOFError if the ring is closed.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.written > seq or self.closed, timeout):
+                return None
+            if self.closed:
+                raise EOFError('Frame ring closed')
+
+            if self.written - seq > self.slots:
+                seq = self.written - 1
+            np.copyto(out, self.frames[seq % self.slots])
+            return seq
+
+
+class ChannelRing(object):
+    """
+    A circular buffer holding the latest <length> samples of
+    <channels> channels, preallocated once. Every sample is stored
+    twice, <length> samples apart, such that the latest samples are
+    always available as a contiguous view, oldest first, without
+    copying or reordering. Writes and copy_latest are serialized, such
+    that a reader on another thread never copies a half written
+    segment.
+    """
+    def __init__(self, channels, length, dtype=np.float32):
+        self.length = length
+        self.data = np.zeros((channels, 2*length), dtype=dtype)
+        self.position = 0
+        self.written = 0
+        self.lock = threading.Lock()
+
+
+    def write(self, samples):
+        """
+        Appends the (channels, samples) array <samples> to every
+        channel.
+        """
+        samples = samples[:, -self.length:]
+        n = samples.shape[1]
+        first = min(n, self.length - self.position)
+        with self.lock:
+            for offset in [self.position, self.position + self.length]:
+                self.data[:, offset:offset+first] = samples[:, :first]
+            if first < n:
+                for offset in [0, self.length]:
+                    self.data[:, offset:offset+n-first] = samples[:, first:]
+
+            self.position = (self.position + n) % self.length
+            self.written += n
+
+
+    def latest(self, n=None):
+        """
+        Returns a view of the latest <n> samples of all channels
+        (everything written so far, up to the full length, if None).
+        The view is overwritten by later writes.
+        """
+        if n is None:
+            n = min(self.written, self.length)
+        end = self.position + self.length
+        return self.data[:, end-n:end]
+
+
+    def copy_latest(self, out):
+        """
+        Copies the latest samples of all channels into the start of
+        <out>, at most as many as fit. Returns the amount of samples
+        copied.
+        """
+        with self.lock:
+            n = min(self.written, self.length, out.shape[1])
+            np.copyto(out[:, :n], self.latest(n))
+            return n
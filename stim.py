@@ -10,8 +10,7 @@ def main(args):
     if args.setup:
         meame.setup_stim()
     if args.start:
-        meame.start_stim()
-        meame.setup_stim()
+        meame.start_stim(setup=True)
     elif args.stop:
         meame.stop_stim()
     elif args.flash:
@@ -0,0 +1,67 @@
+import math
+import numpy as np
+
+
+class RunningWindow(object):
+    """
+    The latest <size> values of a stream, kept in a preallocated ring
+    array along with their running sum, such that appending a value
+    and taking the mean of the window are both constant time no matter
+    the size of the window.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.values = np.zeros(size)
+        self.position = 0
+        self.count = 0
+        self.total = 0.0
+
+
+    def __len__(self):
+        return self.count
+
+
+    def append(self, value):
+        """
+        Appends <value>, evicting the oldest value once the window is
+        full.
+        """
+        self.total += value - self.values[self.position]
+        self.values[self.position] = value
+        self.position = (self.position + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+        # Recompute the sum once per lap of the ring, such that
+        # rounding errors never accumulate.
+        if self.position == 0:
+            self.total = float(self.values.sum())
+
+
+    def full(self):
+        return self.count == self.size
+
+
+    def mean(self):
+        """
+        Returns the mean of the values in the window, or NaN if it is
+        empty.
+        """
+        return self.total / self.count if self.count else math.nan
+
+
+class ExponentialAverage(object):
+    """
+    An exponentially weighted moving average, where every new value
+    is given a weight of <alpha>. The first value starts the average.
+    """
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = math.nan
+
+
+    def update(self, value):
+        if math.isnan(self.value):
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
@@ -0,0 +1,270 @@
+import log
+logger = log.get_logger(__name__)
+
+import experiment
+import inspect
+import numpy as np
+
+
+def is_spec(name):
+    """
+    Returns whether <name> refers to synthetic data rather than an
+    HDF5-file.
+    """
+    return name == 'synthetic' or name.startswith('synthetic:')
+
+
+class SyntheticExperiment(experiment.Experiment):
+    """
+    Generates MEA-like data with known ground truth, and can be used
+    wherever a recording is replayed. <channels> channels of gaussian
+    noise with an RMS of <noise> volts are sampled at <sample_rate>
+    Hz, with:
+
+    - spikes at <spike_rate> Hz per channel, with a trough of about
+      <spike_amplitude> volts,
+    - network bursts at <burst_rate> Hz, where most channels fire at
+      <burst_spike_rate> Hz for <burst_duration> seconds,
+    - stimulation artifacts on all channels at <stim_rate> Hz (none if
+      0), of about <artifact_amplitude> volts and decaying with a time
+      constant of <artifact_decay> seconds.
+
+    The data is a pure function of <seed> and the sample position, as
+    every chunk of data is generated from its own random generator. Any
+    range can thus be generated on demand, in any order, and always
+    yields the same data.
+    """
+    def __init__(self, sample_rate=10000, seconds=600.0, channels=60, seed=0,
+                 noise=5e-6, spike_rate=5.0, spike_amplitude=6e-5,
+                 burst_rate=0.2, burst_duration=0.2, burst_spike_rate=100.0,
+                 stim_rate=0.0, artifact_amplitude=5e-4, artifact_decay=2e-3):
+        self.filename = 'synthetic'
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.samples = int(seconds * sample_rate)
+        self.seed = seed
+        self.current_second = 0
+        self.seconds_per_step = 15
+        self.current_data = [[]]*channels
+
+        self.noise = noise
+        self.spike_rate = spike_rate
+        self.burst_rate = burst_rate
+        self.burst_spike_rate = burst_spike_rate
+        self.burst_samples = max(int(burst_duration * sample_rate), 1)
+        self.stim_rate = stim_rate
+
+        # Each channel gets its own firing rate, spike amplitude and
+        # artifact amplitude, which stay fixed for the whole run.
+        rng = np.random.default_rng([seed])
+        self.channel_rates = spike_rate * rng.uniform(0.5, 1.5, channels)
+        self.channel_amplitudes = spike_amplitude * rng.uniform(0.7, 1.3, channels)
+        self.channel_artifact_gains = artifact_amplitude * rng.uniform(0.5, 1.0, channels)
+
+        # Data is generated in chunks of 100 ms.
+        self.chunk_length = max(int(0.1 * sample_rate), 1)
+        self.init_templates(artifact_decay)
+        self.init_block_cache()
+
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Creates a SyntheticExperiment from a spec such as
+        'synthetic:sample_rate=25000,stim_rate=1', where any keyword
+        argument of the constructor may be given. Values are parsed as
+        numbers, and options that take integers accept any integral
+        value, such as 25000.0 or 2.5e4.
+        """
+        defaults = {name: param.default for name, param in
+                    inspect.signature(cls.__init__).parameters.items() if name != 'self'}
+        kwargs = {}
+        options = spec.partition(':')[2]
+        for option in filter(None, options.split(',')):
+            name, _, value = option.partition('=')
+            if name not in defaults:
+                raise ValueError('Unknown synthetic data option {o}'.format(o=name))
+            try:
+                number = float(value)
+            except ValueError:
+                raise ValueError('Synthetic data option {o} must be a number, not {v!r}'.
+                                 format(o=name, v=value)) from None
+            if isinstance(defaults[name], int):
+                if not number.is_integer():
+                    raise ValueError('Synthetic data option {o} must be an integer, not {v}'.
+                                     format(o=name, v=value))
+                number = int(number)
+            kwargs[name] = number
+
+        logger.info('Generating synthetic data ({o})'.format(o=options or 'defaults'))
+        return cls(**kwargs)
+
+
+    def init_templates(self, artifact_decay):
+        """
+        Samples the waveforms of spikes and stimulation artifacts at
+        the sample rate of the experiment. The spike trough is at
+        sample <spike_pre> of its template, while artifacts start at
+        the first sample of theirs.
+        """
+        ms = 1e-3
+        self.spike_pre = int(1*ms * self.sample_rate)
+        t = (np.arange(-self.spike_pre, int(2*ms * self.sample_rate)) / self.sample_rate)
+        spike = -np.exp(-0.5*(t / (0.25*ms))**2) + 0.35*np.exp(-0.5*((t - 0.6*ms) / (0.5*ms))**2)
+        self.spike_template = (spike / -spike.min()).astype(np.float32)
+
+        # A biphasic stimulation pulse, followed by the amplifiers
+        # recovering from saturation.
+        pulse = 0.2*ms
+        t = np.arange(int((2*pulse + 5*artifact_decay) * self.sample_rate)) / self.sample_rate
+        artifact = np.where(t < pulse, 1.0, np.where(t < 2*pulse, -1.0,
+                            -0.3*np.exp(-(t - 2*pulse) / artifact_decay)))
+        self.artifact_template = artifact.astype(np.float32)
+
+
+    def chunk_spikes(self, chunk):
+        """
+        Returns the channels, sample positions and amplitudes of the
+        spikes generated by chunk number <chunk>. Spikes of bursts
+        starting within the chunk may lie up to a burst duration
+        beyond its end.
+        """
+        rng = np.random.default_rng([self.seed, chunk, 0])
+        chunk_start = chunk * self.chunk_length
+        chunk_seconds = self.chunk_length / self.sample_rate
+
+        counts = rng.poisson(self.channel_rates * chunk_seconds)
+        channels = [np.repeat(np.arange(self.channels), counts)]
+        positions = [chunk_start + rng.integers(0, self.chunk_length, channels[0].size)]
+
+        for burst_start in self.chunk_bursts(chunk):
+            participating = rng.random(self.channels) < 0.8
+            counts = rng.poisson(self.burst_spike_rate * self.burst_samples / self.sample_rate,
+                                 self.channels) * participating
+            burst_channels = np.repeat(np.arange(self.channels), counts)
+            channels.append(burst_channels)
+            positions.append(burst_start + rng.integers(0, self.burst_samples, burst_channels.size))
+
+        channels = np.concatenate(channels)
+        positions = np.concatenate(positions)
+        amplitudes = self.channel_amplitudes[channels] * rng.uniform(0.8, 1.2, channels.size)
+
+        inside = positions < self.samples
+        return channels[inside], positions[inside], amplitudes[inside]
+
+
+    def chunk_bursts(self, chunk):
+        """
+        Returns the sample positions where the bursts of chunk number
+        <chunk> start.
+        """
+        rng = np.random.default_rng([self.seed, chunk, 2])
+        bursts = rng.poisson(self.burst_rate * self.chunk_length / self.sample_rate)
+        return np.sort(chunk * self.chunk_length + rng.integers(0, self.chunk_length, bursts))
+
+
+    def chunk_noise(self, chunk):
+        rng = np.random.default_rng([self.seed, chunk, 1])
+        noise = rng.standard_normal((self.channels, self.chunk_length), dtype=np.float32)
+        noise *= self.noise
+        return noise
+
+
+    def chunks(self, start, stop):
+        """
+        Returns the range of chunks that generate spikes within
+        samples <start> to <stop>.
+        """
+        first = max(start - self.burst_samples, 0) // self.chunk_length
+        last = max(stop - 1, 0) // self.chunk_length
+        return range(first, last + 1)
+
+
+    def spikes(self, start, stop):
+        """
+        Returns the ground truth of spikes with their trough within
+        samples <start> to <stop>, as arrays of channels and sample
+        positions sorted by position.
+        """
+        channels, positions, _ = self.spikes_in_range(start, stop)
+        order = np.argsort(positions, kind='stable')
+        return channels[order], positions[order]
+
+
+    def spikes_in_range(self, start, stop):
+        spikes = [self.chunk_spikes(chunk) for chunk in self.chunks(start, stop)]
+        channels, positions, amplitudes = (np.concatenate(x) for x in zip(*spikes))
+        inside = (positions >= start) & (positions < stop)
+        return channels[inside], positions[inside], amplitudes[inside]
+
+
+    def bursts(self, start, stop):
+        """
+        Returns the ground truth of bursts starting within samples
+        <start> to <stop>.
+        """
+        first, last = start // self.chunk_length, max(stop - 1, 0) // self.chunk_length
+        bursts = np.concatenate([self.chunk_bursts(chunk) for chunk in range(first, last + 1)])
+        return bursts[(bursts >= start) & (bursts < stop)]
+
+
+    def stimuli(self, start, stop):
+        """
+        Returns the ground truth of stimuli applied within samples
+        <start> to <stop>, i.e. where their artifacts start.
+        """
+        if not self.stim_rate:
+            return np.array([], dtype=np.int64)
+        period = self.sample_rate / self.stim_rate
+        first = int(np.ceil((start - period/2) / period))
+        stimuli = np.round(np.arange(first, (stop - period/2) / period) * period + period/2).astype(np.int64)
+        return stimuli[(stimuli >= start) & (stimuli < stop)]
+
+
+    def read_range(self, start, stop, channels=None):
+        """
+        Generates samples <start> to <stop> of the given <channels>
+        (all channels if None) as a (channels, samples) float32 array,
+        the same way Experiment reads them from a recording.
+        """
+        stop = min(stop, self.samples)
+        if channels is None:
+            channels = np.arange(self.channels)
+        channels = np.asarray(channels)
+        length = max(stop - start, 0)
+
+        first, last = start // self.chunk_length, max(stop - 1, 0) // self.chunk_length
+        noise = np.concatenate([self.chunk_noise(chunk)[channels]
+                                for chunk in range(first, last + 1)], axis=1)
+        offset = start - first * self.chunk_length
+        data = np.ascontiguousarray(noise[:, offset:offset + length])
+
+        # Spikes are added where their template overlaps the range,
+        # all at once through fancy indexing.
+        rows = np.full(self.channels, -1)
+        rows[channels] = np.arange(len(channels))
+        spike_post = len(self.spike_template) - self.spike_pre
+        spike_channels, positions, amplitudes = self.spikes_in_range(start - spike_post + 1,
+                                                                     stop + self.spike_pre)
+        selected = rows[spike_channels] >= 0
+        indices = (positions[selected, np.newaxis] - self.spike_pre - start +
+                   np.arange(len(self.spike_template)))
+        waveforms = amplitudes[selected, np.newaxis] * self.spike_template
+        spike_rows = np.broadcast_to(rows[spike_channels[selected], np.newaxis], indices.shape)
+        valid = (indices >= 0) & (indices < length)
+        np.add.at(data, (spike_rows[valid], indices[valid]), waveforms[valid].astype(np.float32))
+
+        gains = self.channel_artifact_gains[channels, np.newaxis].astype(np.float32)
+        for stimulus in self.stimuli(start - len(self.artifact_template) + 1, stop):
+            i, j = max(stimulus - start, 0), min(stimulus - start + len(self.artifact_template), length)
+            data[:, i:j] += gains * self.artifact_template[i - (stimulus - start):j - (stimulus - start)]
+
+        return data
+
+
+    def info(self):
+        print('Experiment INFO: {}'.format(self.filename))
+        print('  {} channels, {} samples per channel, {} hertz'.
+              format(self.channels, self.samples, self.sample_rate))
+        print('  Seed {}, {} Hz spikes, {} Hz bursts, {} Hz stimuli'.
+              format(self.seed, self.spike_rate, self.burst_rate, self.stim_rate))
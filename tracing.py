@@ -0,0 +1,182 @@
+import csv
+import json
+import math
+import threading
+import time
+import numpy as np
+import streamstats
+
+
+class LatencyHistogram(object):
+    """
+    A histogram of latencies in seconds, with <buckets_per_octave>
+    logarithmic buckets per doubling of the latency from <minimum>
+    seconds and up, such that percentiles have about the same relative
+    error (9% with 8 buckets per octave) for microseconds as for
+    seconds. The count, mean, minimum, maximum and an exponential
+    average of the recent latencies are kept exactly.
+    """
+    def __init__(self, minimum=1e-6, octaves=28, buckets_per_octave=8):
+        self.minimum = minimum
+        self.buckets_per_octave = buckets_per_octave
+        self.counts = np.zeros(octaves * buckets_per_octave, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.recent = streamstats.ExponentialAverage(0.1)
+
+
+    def bucket(self, latency):
+        if latency <= self.minimum:
+            return 0
+        index = int(math.log2(latency / self.minimum) * self.buckets_per_octave)
+        return min(index, len(self.counts) - 1)
+
+
+    def upper_bound(self, bucket):
+        return self.minimum * 2**((bucket + 1) / self.buckets_per_octave)
+
+
+    def record(self, latency):
+        self.counts[self.bucket(latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.min = min(self.min, latency)
+        self.max = max(self.max, latency)
+        self.recent.update(latency)
+
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if not math.isnan(other.recent.value):
+            self.recent.update(other.recent.value)
+
+
+    def mean(self):
+        return self.total / self.count if self.count else math.nan
+
+
+    def percentile(self, q):
+        """
+        Returns the <q>th percentile, as the upper bound of the bucket
+        it falls within, kept within the minimum and maximum. Returns
+        None if nothing has been recorded.
+        """
+        if self.count == 0:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 100:
+            return self.max
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+        bucket = min(bucket, len(self.counts) - 1)
+        return max(min(self.upper_bound(bucket), self.max), self.min)
+
+
+    def stats(self):
+        return {'count': self.count, 'mean': self.mean(), 'recent': self.recent.value,
+                'min': self.percentile(0), 'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'p999': self.percentile(99.9), 'max': self.percentile(100)}
+
+
+class Tracer(object):
+    """
+    Timestamped tracepoints and the latencies between them. mark()
+    records when a named point was last passed, from any thread, and
+    span() records the latency from a point until now (or until
+    another point) into a histogram of that span.
+
+    Tracing never takes a lock on the hot path: every thread records
+    into histograms of its own, which are only merged when they are
+    read. Marks are plain dict assignments, which are atomic.
+    """
+    def __init__(self):
+        self.marks = {}
+        self.local = threading.local()
+        self.thread_histograms = []
+
+
+    def mark(self, point, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.marks[point] = timestamp
+        return timestamp
+
+
+    def span(self, name, start_point, end_point=None):
+        """
+        Records the latency of span <name>, from the last time
+        <start_point> was marked until <end_point> was (until now if
+        None). Returns the latency, or None if <start_point> has not
+        been marked.
+        """
+        start = self.marks.get(start_point)
+        if start is None:
+            return None
+        end = time.monotonic() if end_point is None else self.marks[end_point]
+        latency = end - start
+
+        histograms = getattr(self.local, 'histograms', None)
+        if histograms is None:
+            histograms = self.local.histograms = {}
+            self.thread_histograms.append(histograms)
+        if name not in histograms:
+            histograms[name] = LatencyHistogram()
+        histograms[name].record(latency)
+        return latency
+
+
+    def histograms(self):
+        """
+        Returns the histograms of all spans, merged over all threads.
+        """
+        merged = {}
+        for histograms in list(self.thread_histograms):
+            for name, histogram in list(histograms.items()):
+                if name not in merged:
+                    merged[name] = LatencyHistogram()
+                merged[name].merge(histogram)
+        return merged
+
+
+    def summary(self):
+        lines = []
+        for name, histogram in sorted(self.histograms().items()):
+            if histogram.count == 0:
+                continue
+            stats = histogram.stats()
+            lines.append('{name}: {count} spans, {mean:.2f} ms mean, {p50:.2f} ms p50, '
+                         '{p99:.2f} ms p99, {max:.2f} ms max'.format(
+                             name=name, count=stats['count'],
+                             **{k: stats[k]*1000 for k in ['mean', 'p50', 'p99', 'max']}))
+        return lines
+
+
+    def dump(self, filename):
+        """
+        Writes the statistics of all spans to <filename>, as JSON or
+        as CSV (one row per span) depending on its extension. The JSON
+        also contains the bucket counts of every histogram.
+        """
+        histograms = self.histograms()
+        if filename.endswith('.csv'):
+            fields = ['count', 'mean', 'recent', 'min', 'p50', 'p90', 'p99', 'p999', 'max']
+            with open(filename, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['span'] + fields)
+                for name, histogram in sorted(histograms.items()):
+                    stats = histogram.stats()
+                    writer.writerow([name] + [stats[field] for field in fields])
+        else:
+            spans = {}
+            for name, histogram in histograms.items():
+                buckets = np.flatnonzero(histogram.counts)
+                spans[name] = dict(histogram.stats(), buckets=[
+                    {'le': histogram.upper_bound(b), 'count': int(histogram.counts[b])} for b in buckets])
+            with open(filename, 'w') as f:
+                json.dump({'unit': 'seconds', 'spans': spans}, f, indent=2)